@@ -0,0 +1,281 @@
+"""
+Benchmark suite for the paytrace module.
+
+Measures, for every request class, how fast requests are constructed and
+serialized and how much memory that allocates, how fast responses are
+parsed, and the end-to-end throughput and latency of sending requests
+to a local GatewaySimulator standing in for POST_URL with each transport
+backend. Nothing is sent to PayTrace.
+
+Run from the repository root:
+
+  python3 benchmarks/bench_paytrace.py --output results.json
+  python3 benchmarks/bench_paytrace.py --compare results.json
+
+Results are written as JSON so that runs (e.g., before and after an
+upgrade) can be compared with --compare.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import paytrace
+from paytrace_simulator import GatewaySimulator
+
+
+CARD = dict(cc='4012881888818888', expmnth='01', expyr='15')
+ADDRESS = dict(
+    bname='John Doe', baddress='123 Main St.', baddress2='', bcity='Madison',
+    bstate='WI', bzip='53719',
+)
+
+# Representative keyword arguments for each request class.
+REQUESTS = [
+    (paytrace.Sale, dict(amount='1.00', csc='999', invoice='8888', **CARD)),
+    (paytrace.Authorization, dict(amount='1.00', invoice='8888', **CARD)),
+    (paytrace.Refund, dict(tranxid='1539')),
+    (paytrace.Void, dict(tranxid='1539')),
+    (paytrace.ForcedSale, dict(amount='1.00', approval='TAS113', **CARD)),
+    (paytrace.Capture, dict(tranxid='1539')),
+    (paytrace.CashAdvance, dict(
+        amount='100.00', swipe='%B4012881888818888^DOE/JOHN^1501101?',
+        cashadvance='Y', photoid='D123', idexp='12/20', last4='8888',
+        **ADDRESS
+    )),
+    (paytrace.StoreAndForward, dict(amount='1.00', custid='customer1')),
+    (paytrace.CreateCustomer, dict(custid='customer1', bname='John Doe',
+                                   **CARD)),
+    (paytrace.UpdateCustomer, dict(custid='customer1', email='j@example.com')),
+    (paytrace.DeleteCustomer, dict(custid='customer1')),
+    (paytrace.EmailReceipt, dict(EMAIL='j@example.com', TRANXID='1539')),
+    (paytrace.ExportTransaction, dict(SDATE='01/01/2013', EDATE='01/31/2013',
+                                      TRANXTYPE='Sale')),
+    (paytrace.ExportBatch, dict(SDATE='01/31/2013')),
+    (paytrace.SettleTranxRequest, dict()),
+]
+
+RESPONSES = {
+    'approval': (
+        b'RESPONSE~101. Your transaction was successfully approved.|'
+        b'TRANSACTIONID~26303013|APPCODE~TAS113|'
+        b'APPMSG~  NO  MATCH      - Approved and completed|'
+        b'AVSRESPONSE~No Match|CSCRESPONSE~Match|'
+    ),
+    'export_1000': b''.join(
+        b'TRANSACTIONRECORD~TRANXID=%d+AMOUNT=1.00+TRANXTYPE=Sale+'
+        b'STATUS=Settled|' % i
+        for i in range(1000)
+    ),
+}
+
+
+def measure(func, min_time):
+    """
+    Return ops/sec for func and the memory one call allocates: the peak of
+    temporary allocations and the bytes still held by its result.
+
+    """
+    timer = timeit.Timer(func)
+    calibration = 10
+    elapsed = timer.timeit(calibration)
+    number = max(1, int(calibration * min_time / max(elapsed, 1e-9)))
+    elapsed = min(timer.repeat(repeat=3, number=number))
+
+    tracemalloc.start()
+    try:
+        func()  # warm up any caches
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        'ops_per_sec': number / elapsed,
+        'alloc_peak_bytes': peak - baseline,
+        'alloc_retained_bytes': retained - baseline,
+    }
+
+
+def bench_requests(min_time):
+    results = {}
+    for cls, kwargs in REQUESTS:
+        api_request = cls(**kwargs)
+        results[cls.__name__] = {
+            'construct': measure(lambda: cls(**kwargs), min_time),
+            'str': measure(lambda: str(api_request), min_time),
+            'to_bytes': measure(api_request.to_bytes, min_time),
+        }
+    return results
+
+
+def make_response(body):
+    """Build a requests response without a declared charset."""
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = body
+    return response
+
+
+def bench_responses(min_time):
+    results = {}
+    for name, body in sorted(RESPONSES.items()):
+        results[name] = {
+            'parse_response': measure(
+                lambda: paytrace.parse_response(body), min_time
+            ),
+            'LazyResponse': measure(
+                lambda: paytrace.LazyResponse(body).get('RESPONSE'), min_time
+            ),
+            # Decoding alone: what requests' response.text costs (charset
+            # detection included) against decode_response.
+            'response.text': measure(
+                lambda: make_response(body).text, min_time
+            ),
+            'decode_response': measure(
+                lambda: paytrace.decode_response(body), min_time
+            ),
+        }
+    return results
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def latency_summary(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+# Transports compared by the round-trip benchmarks, by name.
+TRANSPORTS = {
+    'requests': paytrace.RequestsTransport,
+    'urllib3': paytrace.Urllib3Transport,
+}
+
+
+def bench_round_trips(count, workers):
+    api_request = paytrace.Sale(amount='1.00', custid='customer1')
+    results = {}
+    with GatewaySimulator() as simulator:
+        for name, transport_class in sorted(TRANSPORTS.items()):
+            transport = transport_class(pool_maxsize=workers)
+            with paytrace.PayTraceClient(simulator.post_url,
+                                         transport=transport) as client:
+                results[name] = bench_client(client, api_request, count,
+                                             workers)
+    return results
+
+
+def bench_client(client, api_request, count, workers):
+    results = {}
+    client.send(api_request)  # open the first connection
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        client.send(api_request)
+        latencies.append(time.perf_counter() - t)
+    results['sequential'] = latency_summary(
+        latencies, time.perf_counter() - start
+    )
+
+    start = time.perf_counter()
+    batch = client.send_many([api_request] * count, workers)
+    elapsed = time.perf_counter() - start
+    assert not any(result.exception for result in batch)
+    results['send_many_%d_workers' % workers] = latency_summary(
+        [result.elapsed for result in batch], elapsed
+    )
+    return results
+
+
+def run(quick=False):
+    min_time = 0.02 if quick else 0.2
+    return {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat() + '+00:00',
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+        },
+        'requests': bench_requests(min_time),
+        'responses': bench_responses(min_time),
+        'round_trips': bench_round_trips(200 if quick else 2000, 8),
+    }
+
+
+def flatten(results, prefix=''):
+    """Yield (name, metric, value) for every measurement in results."""
+    for key, value in sorted(results.items()):
+        if key == 'meta':
+            continue
+        if isinstance(value, dict) and all(
+                not isinstance(v, dict) for v in value.values()):
+            for metric, number in sorted(value.items()):
+                yield prefix + key, metric, number
+        elif isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+
+
+def report(results, baseline=None):
+    previous = {}
+    if baseline is not None:
+        previous = dict(
+            ((name, metric), number)
+            for name, metric, number in flatten(baseline)
+        )
+    for name, metric, number in flatten(results):
+        line = '{0:<50} {1:<22} {2:>14,.1f}'.format(name, metric, number)
+        old = previous.get((name, metric))
+        if old:
+            line += '  ({0:+.1%})'.format(number / old - 1)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--quick', action='store_true',
+                        help='shorter runs (less accurate)')
+    args = parser.parse_args(argv)
+
+    paytrace.set_credentials('demo123', 'demo123')
+    results = run(args.quick)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
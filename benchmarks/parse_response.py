@@ -0,0 +1,114 @@
+"""
+Micro-benchmark parse_response against the implementation it replaced.
+
+The old code parsed response.text, so requests decoded (and, without a
+charset in the Content-Type header, sniffed the encoding of) the body
+before splitting it into str fields. The new code parses response.content
+directly.
+
+Run from the repository root:
+
+  python3 benchmarks/parse_response.py
+
+"""
+
+import os
+import sys
+import timeit
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import paytrace
+
+
+def legacy_parse_response(s):
+    """parse_response as it was before it accepted bytes."""
+    if not s.endswith('|'):
+        raise Exception('Unexpected response: %r' % s[:100])
+
+    try:
+        api_response_dict = dict(s.split('~') for s in s[:-1].split('|'))
+    except:
+        raise Exception('Malformed response: %r' % s)
+
+    return api_response_dict
+
+
+def make_response(body):
+    """Build a requests response the way the gateway's would arrive."""
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = body
+    return response
+
+
+BODIES = {
+    'approval': (
+        b'RESPONSE~101. Your transaction was successfully approved.|'
+        b'TRANSACTIONID~26303013|APPCODE~TAS113|'
+        b'APPMSG~  NO  MATCH      - Approved and completed|'
+        b'AVSRESPONSE~No Match|CSCRESPONSE~Match|'
+    ),
+    'void': (
+        b'RESPONSE~109. Your transaction was successfully voided.|'
+        b'TRANSACTIONID~26303013|'
+    ),
+    'export (5000 records)': b''.join(
+        b'TRANSACTIONRECORD%d~TRANXID=%d+AMOUNT=1.00+TRANXTYPE=Sale+'
+        b'STATUS=Settled|' % (i, i)
+        for i in range(5000)
+    ),
+}
+
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print('{0:<40} {1:>10.2f} us/call'.format(label, seconds / number * 1e6))
+    return seconds
+
+
+def main():
+    for name, body in sorted(BODIES.items()):
+        assert (paytrace.parse_response(body) ==
+                legacy_parse_response(body.decode('utf-8')))
+        number = max(1, 20000000 // (len(body) * 100))
+        text = body.decode('utf-8')
+        print(name)
+        old = bench(
+            '  legacy parse_response(response.text)',
+            lambda: legacy_parse_response(make_response(body).text),
+            number,
+        )
+        new = bench(
+            '  parse_response(response.content)',
+            lambda: paytrace.parse_response(make_response(body).content),
+            number,
+        )
+        print('  speedup: {0:.1f}x'.format(old / new))
+        old = bench(
+            '  legacy parse_response(str)',
+            lambda: legacy_parse_response(text),
+            number,
+        )
+        new = bench(
+            '  parse_response(str)',
+            lambda: paytrace.parse_response(text),
+            number,
+        )
+        print('  speedup: {0:.1f}x'.format(old / new))
+        old = bench(
+            '  legacy parse_response(bytes.decode())',
+            lambda: legacy_parse_response(body.decode('utf-8')),
+            number,
+        )
+        new = bench(
+            '  parse_response(bytes)',
+            lambda: paytrace.parse_response(body),
+            number,
+        )
+        print('  speedup: {0:.1f}x'.format(old / new))
+
+
+if __name__ == '__main__':
+    main()
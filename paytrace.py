@@ -9,12 +9,47 @@ Section references in doc strings below refer to this document.
 
 """
 
+import argparse
+import asyncio
+import contextvars
+import csv
+import hashlib
+import heapq
+import json
+import math
+import os
+import sqlite3
 import sys
-from datetime import datetime
+import threading
+import time
+from array import array
+from collections import (
+    Counter, OrderedDict, defaultdict, deque, namedtuple
+)
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+from itertools import islice
 from textwrap import TextWrapper
-from urllib.parse import urlencode, quote_plus
+from urllib.parse import quote_plus
 
 import requests
+import requests.adapters
+import urllib3
+
+try:
+    import aiohttp
+except ImportError:
+    # aiohttp is only needed by AsyncPayTraceClient.
+    aiohttp = None
+
+try:
+    import numpy
+except ImportError:
+    # numpy is only needed by TransactionColumns.to_numpy.
+    numpy = None
 
 #__all__ = ['parse_response', 'send_api_request']
 
@@ -22,32 +57,1840 @@ import requests
 POST_URL = 'https://paytrace.com/api/default.pay'
 
 
-def parse_response(s):
+class PayTraceError(Exception):
+    """Base class for errors raised by this module."""
+
+
+class UnexpectedResponseError(PayTraceError):
+    """The gateway returned something other than a PayTrace response."""
+
+
+class MalformedResponseError(PayTraceError):
+    """A PayTrace response isn't made of KEY~VALUE| fields."""
+
+
+# Encoding of response bodies, and the encoding used instead for bodies
+# that aren't valid in it. ISO-8859-1 decodes any bytes.
+RESPONSE_ENCODING = 'utf-8'
+FALLBACK_ENCODING = 'iso-8859-1'
+
+
+def decode_response(body, encoding=RESPONSE_ENCODING,
+                    fallback=FALLBACK_ENCODING):
+    """
+    Decode (part of) a response body.
+
+      body     -- bytes
+      encoding -- the encoding to try first
+      fallback -- the encoding to use if body isn't valid in encoding, or
+                  None to raise UnicodeDecodeError instead
+
+    The gateway doesn't say which charset its responses use, so the body
+    is decoded with a known encoding rather than letting requests guess it
+    (response.text runs character set detection over the whole body,
+    which is slow for large exports).
+
     """
-    Parse a PayTrace response string into a dictionary.
+    try:
+        return body.decode(encoding)
+    except UnicodeDecodeError:
+        if fallback is None:
+            raise
+        return body.decode(fallback)
+
+
+def parse_response(s, encoding=RESPONSE_ENCODING, fallback=FALLBACK_ENCODING):
+    """
+    Parse a PayTrace response into a dictionary.
+
+      s        -- the response body as bytes (or a memoryview of them), or
+                  as an already decoded string
+      encoding -- the encoding of a bytes response body
+      fallback -- the encoding used if the body isn't valid in encoding
+                  (see decode_response)
 
     See section 5.1.
 
     """
+    if not isinstance(s, str):
+        s = decode_response(bytes(s), encoding, fallback)
     if not s.endswith('|'):
-        raise Exception('Unexpected response: %r' % s[:100])
+        raise UnexpectedResponseError('Unexpected response: %r' % s[:100])
 
+    # dict() raises ValueError unless every field splits into exactly two.
     try:
-        api_response_dict = dict(s.split('~') for s in s[:-1].split('|'))
-    except:
-        raise Exception('Malformed response: %r' % s)
+        return dict(field.split('~') for field in s[:-1].split('|'))
+    except ValueError:
+        raise MalformedResponseError('Malformed response: %r' % s)
+
+
+class LazyResponse(Mapping):
+    """
+    A read-only, dict-like PayTrace response that decodes values only when
+    they are read.
+
+      body     -- the response body as bytes (or a memoryview of them)
+      encoding -- the encoding of the response body
+      fallback -- the encoding used for fields that aren't valid in
+                  encoding (see decode_response)
+
+    The raw body is kept as is. The offsets of its fields are indexed the
+    first time the response is accessed, and each value is decoded (once)
+    when it's looked up. A LazyResponse supports the usual read-only dict
+    operations: response['TRANSACTIONID'], response.get('APPCODE'),
+    iteration, len() and dict(response).
+
+    Like parse_response, a body without a trailing | raises
+    UnexpectedResponseError right away; a malformed field raises
+    MalformedResponseError on first access.
+
+    """
+    __slots__ = ('_body', '_encoding', '_fallback', '_offsets', '_values')
+
+    def __init__(self, body, encoding=RESPONSE_ENCODING,
+                 fallback=FALLBACK_ENCODING):
+        body = bytes(body)
+        if not body.endswith(b'|'):
+            raise UnexpectedResponseError(
+                'Unexpected response: %r' % body[:100]
+            )
+        self._body = body
+        self._encoding = encoding
+        self._fallback = fallback
+        self._offsets = None
+        self._values = {}
+
+    def _index(self):
+        body = self._body
+        offsets = {}
+        start = 0
+        while start < len(body):
+            end = body.index(b'|', start)
+            separator = body.find(b'~', start, end)
+            if separator == -1 or body.find(b'~', separator + 1, end) != -1:
+                raise MalformedResponseError('Malformed response: %r' % body)
+            key = decode_response(
+                body[start:separator], self._encoding, self._fallback
+            )
+            offsets[key] = (separator + 1, end)
+            start = end + 1
+        self._offsets = offsets
+        return offsets
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._index()
+        start, end = offsets[key]
+        value = self._values[key] = decode_response(
+            self._body[start:end], self._encoding, self._fallback
+        )
+        return value
+
+    def __iter__(self):
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._index()
+        return iter(offsets)
+
+    def __len__(self):
+        offsets = self._offsets
+        if offsets is None:
+            offsets = self._index()
+        return len(offsets)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def iter_records(chunks, encoding=RESPONSE_ENCODING,
+                 fallback=FALLBACK_ENCODING):
+    """
+    Parse a PayTrace response arriving in pieces, yielding one (key, value)
+    pair per KEY~VALUE| record.
+
+      chunks   -- an iterable of bytes, split anywhere (records may span
+                  chunks)
+      encoding -- the encoding of the response body
+      fallback -- the encoding used for records that aren't valid in
+                  encoding (see decode_response)
+
+    Only the current partial record is buffered, so memory use doesn't
+    depend on the size of the response. Unlike parse_response, repeated
+    keys (such as the TRANSACTIONRECORD entries of an ExportTransaction
+    response) are all yielded. Like parse_response, an empty body, or one
+    without a trailing |, raises UnexpectedResponseError.
+
+    See section 5.1.
+
+    """
+    buffer = b''
+    framed = False
+    for chunk in chunks:
+        buffer += chunk
+        if b'|' not in chunk:
+            continue
+        *records, buffer = buffer.split(b'|')
+        framed = True
+        for record in records:
+            try:
+                key, value = decode_response(
+                    record, encoding, fallback
+                ).split('~')
+            except ValueError:
+                raise MalformedResponseError(
+                    'Malformed response record: %r' % record
+                )
+            yield key, value
+    if buffer or not framed:
+        raise UnexpectedResponseError('Unexpected response: %r' % buffer[:100])
+
+
+def parse_record(value):
+    """
+    Parse the value of an export record (TRANSACTIONRECORD, ...) into a
+    dictionary. Export records pack their fields as NAME=VALUE pairs
+    separated by '+'; a '+' that isn't followed by NAME= is kept as part of
+    the preceding value.
+
+    See section 4.4.
+
+    """
+    record = {}
+    name = None
+    for item in value.split('+'):
+        key, sep, field_value = item.partition('=')
+        if sep and key.isupper():
+            name = key
+            record[name] = field_value
+        elif name is not None:
+            record[name] += '+' + item
+    return record
 
-    return api_response_dict
 
+#
+# Instrumentation
+#
 
-def send_api_request(api_request, post_url=POST_URL):
+class CallTiming(object):
+    """
+    Timing record for one API call, passed to Instrument.after_send.
+
+      request_class  -- name of the PayTraceRequest subclass sent
+      method         -- the request's METHOD
+      tranxtype      -- the request's TRANXTYPE, or None
+      phases         -- seconds spent in each phase of the call, keyed by
+                        'serialize', 'connect' (TCP), 'tls', 'server'
+                        (sending the request and waiting for the response
+                        headers), 'transfer' (reading the response body)
+                        and 'parse'; connect and tls are absent when a
+                        kept-alive connection was reused
+      total          -- seconds spent in the whole call
+      bytes_sent     -- size of the request body
+      bytes_received -- size of the response body
+      outcome        -- 'ok', 'error' (the gateway returned ERROR),
+                        'send_error' or 'parse_error'
+
+    """
+    __slots__ = (
+        'request_class', 'method', 'tranxtype', 'phases', 'total',
+        'bytes_sent', 'bytes_received', 'outcome', '_start', '_mark',
+    )
+
+    def __init__(self, api_request):
+        self.request_class = api_request.__class__.__name__
+        self.method = getattr(api_request, 'METHOD', None)
+        self.tranxtype = getattr(api_request, 'TRANXTYPE', None)
+        self.phases = {}
+        self.total = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.outcome = None
+        self._start = self._mark = time.perf_counter()
+
+    def mark(self, phase):
+        """Record the time since the previous mark as phase."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._mark
+        self._mark = now
+
+    def finish(self, outcome):
+        self.outcome = outcome
+        self.total = time.perf_counter() - self._start
+
+    def __repr__(self):
+        return '<CallTiming {0} {1}/{2} {3} {4:.1f} ms>'.format(
+            self.request_class, self.method, self.tranxtype, self.outcome,
+            (self.total or 0) * 1000,
+        )
+
+
+class Instrument(object):
+    """
+    Base class for client instrumentation hooks.
+
+    Add an instrument to a client with add_instrument(); the client then
+    calls before_send() before each request and after_send(), with the
+    call's CallTiming, once it completes or fails. Clients without
+    instruments don't time their calls at all.
+
+    """
+    def before_send(self, api_request):
+        pass
+
+    def after_send(self, api_request, timing):
+        pass
+
+
+class Histogram(object):
+    """
+    A log-bucketed histogram of durations in seconds, accurate to within
+    about 10%, from 1 microsecond to over a minute.
+
+    """
+    _factor = 2 ** 0.25
+    _smallest = 1e-6
+    _buckets = 112  # _smallest * _factor ** 112 is about 268 seconds
+
+    def __init__(self):
+        self.counts = [0] * (self._buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value <= self._smallest:
+            index = 0
+        else:
+            index = min(
+                self._buckets,
+                int(math.log(value / self._smallest, self._factor)) + 1,
+            )
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """Return the (upper bucket bound of the) given percentile."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.max, self._smallest * self._factor ** index)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class MetricsRecorder(Instrument):
+    """
+    Aggregate CallTiming records into histograms and counters.
+
+      latency  -- a Histogram of total call time per (METHOD, TRANXTYPE)
+      phases   -- a Histogram per phase name
+      outcomes -- a Counter of (METHOD, TRANXTYPE, outcome)
+      bytes_sent, bytes_received -- running totals
+
+    For example,
+
+        metrics = MetricsRecorder()
+        get_default_client().add_instrument(metrics)
+        ...
+        metrics.summary()
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(Histogram)
+        self.phases = defaultdict(Histogram)
+        self.outcomes = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def after_send(self, api_request, timing):
+        with self._lock:
+            self.latency[timing.method, timing.tranxtype].record(timing.total)
+            for phase, seconds in timing.phases.items():
+                self.phases[phase].record(seconds)
+            self.outcomes[timing.method, timing.tranxtype, timing.outcome] += 1
+            self.bytes_sent += timing.bytes_sent
+            self.bytes_received += timing.bytes_received
+
+    def summary(self):
+        """Return the aggregated metrics as a dictionary."""
+        with self._lock:
+            return {
+                'latency': dict(
+                    ('/'.join(filter(None, key)), histogram.summary())
+                    for key, histogram in self.latency.items()
+                ),
+                'phases': dict(
+                    (phase, histogram.summary())
+                    for phase, histogram in self.phases.items()
+                ),
+                'outcomes': dict(
+                    ('/'.join(filter(None, key)), count)
+                    for key, count in self.outcomes.items()
+                ),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+            }
+
+
+class AdaptiveTimeouts(Instrument):
+    """
+    Derive connect and read timeouts, and hedging delays, from recent
+    latencies, per kind of call: (METHOD, TRANXTYPE), with exports split
+    by TRANXID lookups and date range lengths. Give it to a client with
+    PayTraceClient(timeouts=...), which also adds it as an instrument.
+    Calls made with send() and stream() are both counted.
+
+      window      -- number of recent calls per kind the percentiles are
+                     taken over
+      min_samples -- calls needed before the client's fixed timeout is
+                     replaced
+      multiplier  -- timeouts are this many times the p99 latency
+      connect     -- (minimum, maximum) connect timeout in seconds
+      read        -- (minimum, maximum) read timeout in seconds
+      hedge       -- if True, hedge idempotent reads (see below)
+
+    The read timeout bounds each wait for the gateway, so it's based on
+    the time calls spend sending and waiting for the response; the connect
+    timeout is based on the time new connections take to open, across all
+    calls. A call that times out is counted as taking the whole timeout,
+    so the timeout grows again if the gateway slows down.
+
+    With hedge, an ExportTransaction by TRANXID or an ExportBatch still
+    unanswered after the p95 latency of its kind is sent a second time,
+    and the first answer wins. Nothing else is hedged, since sending it
+    twice could process it twice.
+
+    Note that a timed out ProcessTranx may still have been processed; see
+    Reconciler.
+
+    """
+    def __init__(self, window=500, min_samples=20, multiplier=4,
+                 connect=(0.5, 10), read=(2, 60), hedge=False):
+        self.window = window
+        self.min_samples = min_samples
+        self.multiplier = multiplier
+        self.connect_bounds = connect
+        self.read_bounds = read
+        self.hedge = hedge
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._connects = deque(maxlen=window)
+        self._seen = Counter()  # key -> calls recorded
+        self._percentiles = {}  # key -> (samples seen, p95, p99)
+
+    def _percentile(self, key, samples, index):
+        cached = self._percentiles.get(key)
+        # Sorting the window again every few calls is plenty.
+        if cached is None or cached[0] + max(1, len(samples) // 20) <= \
+                self._seen[key]:
+            ordered = sorted(samples)
+            cached = self._percentiles[key] = (
+                self._seen[key],
+                ordered[int(len(ordered) * 0.95)],
+                ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+            )
+        return cached[index]
+
+    # Date range exports by the number of days they span (see _key).
+    _export_spans = ((1, '1 day'), (7, '2-7 days'), (31, '8-31 days'))
+
+    @classmethod
+    def _key(cls, api_request):
+        """
+        Return the key api_request's latencies are kept under: its METHOD
+        and TRANXTYPE, except that an ExportTransaction is keyed on
+        whether it looks up a TRANXID or, if not, on the length of its
+        date range, and an ExportBatch on its METHOD alone, since their
+        TRANXTYPE only filters the records returned.
+
+        """
+        method = getattr(api_request, 'METHOD', None)
+        if method == 'ExportBatch':
+            return (method, None)
+        if method != 'ExportTranx':
+            return (method, getattr(api_request, 'TRANXTYPE', None))
+        if getattr(api_request, 'TRANXID', None):
+            return (method, 'TRANXID')
+        try:
+            days = (_as_date(api_request.EDATE) -
+                    _as_date(api_request.SDATE)).days + 1
+        except (AttributeError, ValueError):
+            return (method, 'range')
+        for most, span in cls._export_spans:
+            if days <= most:
+                return (method, span)
+        return (method, '32+ days')
+
+    def _bounded(self, seconds, bounds):
+        return min(bounds[1], max(bounds[0], seconds * self.multiplier))
+
+    def timeout(self, api_request, default):
+        """
+        Return the (connect, read) timeout for api_request, or default
+        until enough calls like it have been seen.
+
+        """
+        with self._lock:
+            return self._timeout(self._key(api_request), default)
+
+    def _timeout(self, key, default):
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return default
+        read = self._bounded(
+            self._percentile(key, samples, 2), self.read_bounds
+        )
+        if len(self._connects) >= self.min_samples:
+            connect = self._bounded(
+                self._percentile('connect', self._connects, 2),
+                self.connect_bounds,
+            )
+        else:
+            connect = self.connect_bounds[1]
+        return (connect, read)
+
+    def hedge_delay(self, api_request):
+        """
+        Return the seconds to wait before hedging api_request, or None if
+        it mustn't (or can't yet) be hedged.
+
+        """
+        if not self.hedge or not is_idempotent_read(api_request):
+            return None
+        key = self._key(api_request)
+        with self._lock:
+            samples = self._samples.get(key)
+            if not samples or len(samples) < self.min_samples:
+                return None
+            return self._percentile(key, samples, 1)
+
+    def after_send(self, api_request, timing):
+        phases = timing.phases
+        if 'server' in phases:
+            waited = phases['server'] + phases.get('transfer', 0)
+        elif timing.outcome == 'send_error':
+            # Probably a timeout; count the whole wait.
+            waited = timing.total - sum(
+                phases.get(phase, 0) for phase in ('serialize', 'queue')
+            )
+        else:
+            return  # answered from a cache
+        key = self._key(api_request)
+        with self._lock:
+            self._samples[key].append(waited)
+            self._seen[key] += 1
+            if 'connect' in phases:
+                self._connects.append(phases['connect'])
+                self._seen['connect'] += 1
+
+    def _tally(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def summary(self):
+        """Return the current timeouts and hedging counts."""
+        with self._lock:
+            timeouts = dict(
+                ('/'.join(filter(None, key)), self._timeout(key, None))
+                for key in self._samples
+            )
+            return {
+                'timeouts': timeouts,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+            }
+
+
+def is_idempotent_read(api_request):
+    """
+    Return True if sending api_request twice has the same effect as
+    sending it once: an ExportBatch, or an ExportTransaction by TRANXID.
+
+    """
+    method = getattr(api_request, 'METHOD', None)
+    return method == 'ExportBatch' or (
+        method == 'ExportTranx' and bool(getattr(api_request, 'TRANXID', None))
+    )
+
+
+def _timed_iter(iterable, phases, phase):
+    """Iterate over iterable, adding the time each step takes to phase."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            phases[phase] += time.perf_counter() - start
+        yield item
+
+
+# The CallTiming of the call in progress on this thread, if instrumented.
+_current_timing = threading.local()
+
+
+class _TimedConnectionMixin(object):
+    """Record TCP connect and TLS handshake times for new connections."""
+
+    def _new_conn(self):
+        timing = getattr(_current_timing, 'timing', None)
+        if timing is None:
+            return super()._new_conn()
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        timing.phases['connect'] = time.perf_counter() - start
+        return sock
+
+    def connect(self):
+        timing = getattr(_current_timing, 'timing', None)
+        if timing is None:
+            return super().connect()
+        start = time.perf_counter()
+        super().connect()
+        tls = time.perf_counter() - start - timing.phases.get('connect', 0)
+        if isinstance(self, urllib3.connection.HTTPSConnection):
+            timing.phases['tls'] = tls
+
+
+class _TimedHTTPConnection(_TimedConnectionMixin,
+                           urllib3.connection.HTTPConnection):
+    pass
+
+
+class _TimedHTTPSConnection(_TimedConnectionMixin,
+                            urllib3.connection.HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """An HTTPAdapter whose connections report connect and TLS times."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+#
+# Transports
+#
+
+# Headers sent with every request.
+_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+TransportResponse = namedtuple(
+    'TransportResponse', ['status_code', 'content', 'elapsed']
+)
+TransportResponse.__doc__ = """
+    A gateway response as returned by Transport.post.
+
+      status_code -- the HTTP status code
+      content     -- the response body (bytes)
+      elapsed     -- seconds from sending the request to receiving the
+                     response headers, or None if unknown
+
+    """
+
+
+class Transport(object):
+    """
+    Base class of the HTTP backends PayTraceClient sends requests with.
+
+    A transport POSTs form-encoded request bodies and returns raw response
+    bytes; encoding requests and parsing responses is left to the client.
+    Exceptions are raised as the underlying library raises them.
+
+    A timeout is either seconds or a (connect, read) pair of seconds, as
+    with requests.
+
+    """
+    def post(self, url, data, timeout):
+        """POST data to url and return a TransportResponse."""
+        raise NotImplementedError
+
+    def post_stream(self, url, data, timeout, chunk_size):
+        """
+        POST data to url and return (status_code, chunks), where chunks is
+        a generator of the response body's bytes read chunk_size at a time.
+        The connection is released when the generator is exhausted or
+        closed.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Close any pooled connections."""
+
+
+class RequestsTransport(Transport):
+    """
+    A transport using a requests Session. This is the default.
+
+      pool_connections -- number of per-host connection pools to keep
+      pool_maxsize     -- maximum number of keep-alive connections per host
+      pool_block       -- if True, never open more than pool_maxsize
+                          connections to a host; wait for a free one instead
+
+    """
+    def __init__(self, pool_connections=1, pool_maxsize=10,
+                 pool_block=False):
+        self.session = requests.Session()
+        adapter = _TimedHTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update(_HEADERS)
+
+    def post(self, url, data, timeout):
+        response = self.session.post(url, data=data, timeout=timeout)
+        return TransportResponse(
+            response.status_code,
+            response.content,
+            response.elapsed.total_seconds(),
+        )
+
+    def post_stream(self, url, data, timeout, chunk_size):
+        response = self.session.post(
+            url, data=data, timeout=timeout, stream=True
+        )
+        return response.status_code, self._chunks(response, chunk_size)
+
+    @staticmethod
+    def _chunks(response, chunk_size):
+        with response:
+            yield from response.iter_content(chunk_size)
+
+    def close(self):
+        self.session.close()
+
+
+class Urllib3Transport(Transport):
+    """
+    A lean transport using a urllib3 PoolManager directly.
+
+      pool_maxsize -- maximum number of keep-alive connections per host
+      pool_block   -- if True, never open more than pool_maxsize
+                      connections to a host; wait for a free one instead
+
+    It skips the hooks, cookie handling, adapters and response wrapping of
+    requests, which add up to a large share of the client CPU time of
+    PayTrace's small form-encoded POSTs. Redirects and retries are
+    disabled, as the gateway never needs them.
+
+    """
+    def __init__(self, pool_maxsize=10, pool_block=False):
+        self.pool_manager = urllib3.PoolManager(
+            maxsize=pool_maxsize, block=pool_block, headers=_HEADERS,
+        )
+        self.pool_manager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+    def _urlopen(self, url, data, timeout):
+        if isinstance(timeout, tuple):
+            timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+        return self.pool_manager.urlopen(
+            'POST', url, body=data, timeout=timeout, retries=False,
+            redirect=False, preload_content=False,
+        )
+
+    def post(self, url, data, timeout):
+        start = time.perf_counter()
+        response = self._urlopen(url, data, timeout)
+        elapsed = time.perf_counter() - start
+        try:
+            content = response.read()
+        finally:
+            response.release_conn()
+        return TransportResponse(response.status, content, elapsed)
+
+    def post_stream(self, url, data, timeout, chunk_size):
+        response = self._urlopen(url, data, timeout)
+        return response.status, self._chunks(response, chunk_size)
+
+    @staticmethod
+    def _chunks(response, chunk_size):
+        try:
+            yield from response.stream(chunk_size)
+        finally:
+            response.release_conn()
+
+    def close(self):
+        self.pool_manager.clear()
+
+
+class MemoryTransport(Transport):
+    """
+    A transport that never touches the network, for tests.
+
+      handler -- an optional function called with each request body
+                 (bytes) that returns the response body (bytes or str) or
+                 a (status_code, body) pair
+
+    Responses added with queue() are returned first, in order; once
+    they're used up, handler answers. Queue an exception to have it
+    raised instead. Every (url, data) sent is kept in requests.
+
+    For example,
+
+        transport = MemoryTransport()
+        transport.queue('RESPONSE~101. Approved.|TRANSACTIONID~1|')
+        transport.queue(requests.Timeout())
+        client = PayTraceClient(transport=transport)
+
+    or, to answer as the gateway simulator would,
+
+        simulator = GatewaySimulator()
+        transport = MemoryTransport(
+            lambda data: simulator.process(parse_parmlist(data))
+        )
+
+    """
+    def __init__(self, handler=None):
+        self.handler = handler
+        self.requests = []
+        self._responses = deque()
+        self._lock = threading.Lock()
+
+    def queue(self, body, status_code=200):
+        """Add a response body (or exception) to be returned next."""
+        with self._lock:
+            self._responses.append((status_code, body))
+
+    def _respond(self, url, data):
+        with self._lock:
+            self.requests.append((url, data))
+            queued = self._responses.popleft() if self._responses else None
+        if queued is not None:
+            status_code, body = queued
+        elif self.handler is not None:
+            body = self.handler(data)
+            status_code = 200
+            if isinstance(body, tuple):
+                status_code, body = body
+        else:
+            raise LookupError('No response queued for ' + url)
+        if isinstance(body, BaseException):
+            raise body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        return status_code, body
+
+    def post(self, url, data, timeout):
+        status_code, body = self._respond(url, data)
+        return TransportResponse(status_code, body, None)
+
+    def post_stream(self, url, data, timeout, chunk_size):
+        status_code, body = self._respond(url, data)
+        return status_code, (
+            body[i:i + chunk_size] for i in range(0, len(body), chunk_size)
+        )
+
+
+#
+# Response cache
+#
+
+class ResponseCache(object):
+    """
+    A TTL and LRU cache of responses to read-only requests, for use by
+    PayTraceClient and AsyncPayTraceClient.
+
+      ttls      -- seconds to keep responses, keyed by request class
+                   (defaults to 30 for ExportTransaction and 60 for
+                   ExportBatch); a class's TTL also applies to its
+                   subclasses, such as those made by RequestTemplate
+      max_bytes -- the most response bytes kept; the least recently used
+                   responses are evicted beyond that
+
+    Only export requests (METHOD ExportTranx or ExportBatch) are ever
+    cached: transactions, customer profile changes, receipts and
+    settlement always reach the gateway. Responses with an ERROR aren't
+    cached either.
+
+    Entries are keyed on a SHA-256 digest of the serialized request, so
+    the credentials in it aren't kept in memory, and requests made with
+    different credentials never share entries. Each hit returns a newly
+    parsed response.
+
+    For example,
+
+        client = PayTraceClient(cache=ResponseCache(max_bytes=10 * 2**20))
+        ...
+        client.cache.stats()
+
+    """
+    _cacheable_methods = frozenset(['ExportTranx', 'ExportBatch'])
+
+    def __init__(self, ttls=None, max_bytes=2 ** 20):
+        if ttls is None:
+            ttls = {ExportTransaction: 30, ExportBatch: 60}
+        for cls in ttls:
+            if getattr(cls, 'METHOD', None) not in self._cacheable_methods:
+                raise ValueError(
+                    '{0} requests must not be cached'.format(cls.__name__)
+                )
+        self.ttls = dict(ttls)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()  # key -> (expires, body)
+        self._lock = threading.Lock()
+
+    def key(self, api_request, data):
+        """
+        Return the cache key for api_request serialized as data, or None
+        if the request isn't cacheable.
+
+        """
+        if self._ttl(api_request) is None:
+            return None
+        return hashlib.sha256(data).digest()
+
+    def _ttl(self, api_request):
+        for cls in api_request.__class__.__mro__:
+            ttl = self.ttls.get(cls)
+            if ttl is not None:
+                return ttl
+        return None
+
+    def get(self, key):
+        """Return the cached response body for key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, body = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.size -= len(body)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, api_request, body):
+        """Cache a response body for key."""
+        if len(body) > self.max_bytes:
+            return
+        expires = time.monotonic() + self._ttl(api_request)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (expires, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Return hit, miss, eviction and size statistics."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'entries': len(self._entries),
+                'bytes': self.size,
+            }
+
+
+#
+# Scheduling
+#
+
+# Scheduler priority classes; lower numbers are sent first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_BACKGROUND = 2
+
+
+def default_priority(api_request):
+    """
+    Return the Scheduler priority class of api_request: background for
+    exports and receipts, bulk for captures and settlement, and
+    interactive for everything else (sales, refunds, customer profiles).
+
+    """
+    method = api_request.METHOD
+    if method in ('ExportTranx', 'ExportBatch', 'EmailReceipt'):
+        return PRIORITY_BACKGROUND
+    if method == SettleTranxRequest.METHOD or (
+            method == 'ProcessTranx' and api_request.TRANXTYPE == 'Capture'):
+        return PRIORITY_BULK
+    return PRIORITY_INTERACTIVE
+
+
+class Scheduler(object):
+    """
+    A token-bucket rate limiter and priority queue in front of a
+    PayTraceClient's send path.
+
+      rate          -- requests per second allowed on average, or None for
+                       no rate limit
+      burst         -- requests allowed at once after an idle period (the
+                       token bucket's size)
+      max_in_flight -- requests allowed in flight at once, or None for no
+                       limit
+      priority      -- a function returning a request's priority class;
+                       lower classes go first (defaults to
+                       default_priority)
+
+    A request waits until it is the first of the highest priority class
+    waiting, a token is available and (if limited) fewer than
+    max_in_flight requests are in flight. So batch jobs sharing a client
+    with checkout never hold a live sale back by more than one request,
+    and together they stay under the gateway's limits.
+
+    stats() reports the queue depth and wait times per priority class.
+    Waits that grow while the rate limit is hit mean the client is
+    offering more load than the limit allows.
+
+    For example,
+
+        client = PayTraceClient(scheduler=Scheduler(rate=20, burst=5))
+        ...
+        client.scheduler.stats()
+
+    """
+    def __init__(self, rate=None, burst=1, max_in_flight=None,
+                 priority=default_priority):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.priority = priority
+        self.in_flight = 0
+        self.throttled = 0
+        self.max_queue_depth = 0
+        self.waits = defaultdict(Histogram)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._queue = []  # heap of (priority, sequence)
+        self._sequence = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+
+    def acquire(self, api_request):
+        """
+        Wait until api_request may be sent and return the seconds waited.
+        Call release() once it has been sent.
+
+        """
+        priority = self.priority(api_request)
+        start = time.monotonic()
+        with self._cond:
+            entry = (priority, self._sequence)
+            self._sequence += 1
+            heapq.heappush(self._queue, entry)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+            throttled = False
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                timeout = None
+                if self._queue[0] == entry and (
+                        self.max_in_flight is None or
+                        self.in_flight < self.max_in_flight):
+                    if self.rate is None or self._tokens >= 1:
+                        break
+                    throttled = True
+                    timeout = (1 - self._tokens) / self.rate
+                self._cond.wait(timeout)
+            heapq.heappop(self._queue)
+            if self.rate is not None:
+                self._tokens -= 1
+            self.in_flight += 1
+            self.throttled += throttled
+            wait = now - start
+            self.waits[priority].record(wait)
+            # The next request in line may be able to go too.
+            self._cond.notify_all()
+        return wait
+
+    def release(self):
+        """Note that a request acquired with acquire() has been sent."""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return queue depth, in-flight and wait time statistics."""
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'queue_depth': len(self._queue),
+                'queue_depth_by_priority': dict(Counter(
+                    priority for priority, _ in self._queue
+                )),
+                'max_queue_depth': self.max_queue_depth,
+                'in_flight': self.in_flight,
+                'tokens': self._tokens if self.rate is not None else None,
+                'throttled': self.throttled,
+                'wait': dict(
+                    (priority, histogram.summary())
+                    for priority, histogram in self.waits.items()
+                ),
+            }
+
+
+#
+# Clients
+#
+
+class PayTraceClient(object):
+    """
+    Send PayTrace API requests over a persistent, pooled HTTP session.
+
+    Each call to requests.post opens a new connection and performs a new TLS
+    handshake with the gateway. A client keeps its connections alive between
+    requests, so only the first request to POST_URL pays that cost.
+
+      post_url         -- the PayTrace API endpoint
+      timeout          -- seconds to wait for the gateway before giving up
+      pool_connections -- number of per-host connection pools to keep
+      pool_maxsize     -- maximum number of keep-alive connections per host
+      pool_block       -- if True, never open more than pool_maxsize
+                          connections to a host; wait for a free one instead
+      cache            -- an optional ResponseCache for export requests
+      transport        -- the Transport to send with (defaults to a
+                          RequestsTransport using the pool_* arguments)
+      scheduler        -- an optional Scheduler to rate limit and
+                          prioritize requests
+      timeouts         -- an optional AdaptiveTimeouts to use instead of
+                          timeout once it has seen enough calls, and to
+                          hedge export requests with
+      credentials      -- the Credentials to send requests with (defaults to
+                          current_credentials() at the time of sending)
+      encoding         -- the encoding of response bodies
+      fallback_encoding -- the encoding used for responses that aren't
+                          valid in encoding (see decode_response)
+
+    A client is safe to share between threads. Call close() (or use the
+    client as a context manager) to release its connections.
+
+    Instruments added with add_instrument() are told about every call
+    along with a per-phase CallTiming.
+
+    """
+    def __init__(self, post_url=POST_URL, timeout=60, pool_connections=1,
+                 pool_maxsize=10, pool_block=False, cache=None,
+                 transport=None, scheduler=None, timeouts=None,
+                 credentials=None, encoding=RESPONSE_ENCODING,
+                 fallback_encoding=FALLBACK_ENCODING):
+        self.post_url = post_url
+        self.credentials = credentials
+        self.encoding = encoding
+        self.fallback_encoding = fallback_encoding
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.cache = cache
+        self.scheduler = scheduler
+        self.timeouts = timeouts
+        self.instruments = []
+        if timeouts is not None:
+            self.instruments.append(timeouts)
+        if transport is None:
+            transport = RequestsTransport(
+                pool_connections, pool_maxsize, pool_block
+            )
+        self.transport = transport
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close all pooled connections."""
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        self.transport.close()
+
+    def add_instrument(self, instrument):
+        """Add an Instrument to be called around every request."""
+        self.instruments.append(instrument)
+
+    def send(self, api_request, lazy=False):
+        """
+        Send a PayTrace API request and get a response.
+
+          api_request -- a subclass of PayTraceRequest
+          lazy        -- if True, return a LazyResponse instead of a dict
+
+        Return the PayTrace response parsed into a dictionary. See
+        send_api_request for details.
+
+        """
+        delay = None
+        if self.timeouts is not None:
+            delay = self.timeouts.hedge_delay(api_request)
+        if delay is None:
+            return self._send_one(api_request, lazy)
+        return self._send_hedged(api_request, lazy, delay)
+
+    def _send_hedged(self, api_request, lazy, delay):
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=2 * self.pool_maxsize
+                )
+        executor = self._hedge_executor
+
+        def submit():
+            return executor.submit(
+                contextvars.copy_context().run,
+                self._send_one, api_request, lazy,
+            )
+
+        first = submit()
+        done, pending = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        second = submit()
+        self.timeouts._tally('hedged')
+        pending = [first, second]
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in (first, second):
+                if future not in done:
+                    continue
+                if future.exception() is None:
+                    if future is second:
+                        self.timeouts._tally('hedge_wins')
+                    # The other request is left to finish (or time out) on
+                    # its own, unless it hasn't started yet.
+                    first.cancel()
+                    second.cancel()
+                    return future.result()
+                errors.append(future)
+        errors.sort(key=lambda future: future is second)
+        return errors[0].result()
+
+    def _send_one(self, api_request, lazy):
+        if not self.instruments:
+            return self._send(api_request, lazy, None)
+
+        for instrument in self.instruments:
+            instrument.before_send(api_request)
+        timing = _current_timing.timing = CallTiming(api_request)
+        try:
+            api_response_dict = self._send(api_request, lazy, timing)
+        except:
+            if timing.outcome is None:
+                timing.finish('send_error')
+            raise
+        else:
+            timing.finish('error' if 'ERROR' in api_response_dict else 'ok')
+        finally:
+            _current_timing.timing = None
+            for instrument in self.instruments:
+                instrument.after_send(api_request, timing)
+        return api_response_dict
+
+    def _send(self, api_request, lazy, timing):
+        data = api_request.to_bytes(self.credentials)
+        if timing is not None:
+            timing.mark('serialize')
+            timing.bytes_sent = len(data)
+        # A cached response never reaches the gateway, so it doesn't wait
+        # for (or use up) the scheduler's capacity.
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(api_request, data)
+            body = cache_key and self.cache.get(cache_key)
+            if body:
+                return self._parse(body, lazy)
+
+        if self.scheduler is None:
+            return self._send_now(api_request, data, cache_key, lazy, timing)
+        self.scheduler.acquire(api_request)
+        try:
+            if timing is not None:
+                timing.mark('queue')
+            return self._send_now(api_request, data, cache_key, lazy, timing)
+        finally:
+            self.scheduler.release()
+
+    def _send_now(self, api_request, data, cache_key, lazy, timing):
+        utc_timestamp = '%s+00:00' % datetime.utcnow()
+        try:
+            response = self.transport.post(
+                self.post_url, data, self._timeout_for(api_request)
+            )
+        except KeyboardInterrupt:
+            raise
+        except:
+            exc_class, exc_instance = sys.exc_info()[:2]
+            raise Exception(
+                'Error sending HTTP POST.',
+                {'exc_instance': exc_instance,
+                 'api_request': repr(api_request),
+                 'api_request_raw': data.decode('ascii'),
+                 'utc_timestamp': utc_timestamp}
+            )
+        if timing is not None:
+            # response.elapsed runs from sending the request (including
+            # opening a connection) to parsing the response headers.
+            now = time.perf_counter()
+            network = now - timing._mark
+            waiting = network
+            if response.elapsed is not None:
+                waiting = min(network, response.elapsed)
+            timing.phases['server'] = max(0.0, waiting - sum(
+                timing.phases.get(phase, 0) for phase in ('connect', 'tls')
+            ))
+            timing.phases['transfer'] = network - waiting
+            timing._mark = now
+            timing.bytes_received = len(response.content)
+
+        try:
+            api_response_dict = self._parse(response.content, lazy)
+        except KeyboardInterrupt:
+            raise
+        except:
+            exc_class, exc_instance = sys.exc_info()[:2]
+            if timing is not None:
+                timing.finish('parse_error')
+            raise Exception(
+                'Error parsing HTTP response.',
+                {'exc_instance': exc_instance,
+                 'api_request': repr(api_request),
+                 'api_request_raw': data.decode('ascii'),
+                 'api_response': response.content[:100],
+                 'http_status': response.status_code,
+                 'utc_timestamp': utc_timestamp}
+            )
+        if timing is not None:
+            timing.mark('parse')
+        if cache_key is not None and 'ERROR' not in api_response_dict:
+            self.cache.put(cache_key, api_request, response.content)
+
+        return api_response_dict
+
+    def _timeout_for(self, api_request, timeout=None):
+        if timeout:
+            return timeout
+        if self.timeouts is not None:
+            return self.timeouts.timeout(api_request, self.timeout)
+        return self.timeout
+
+    def _parse(self, body, lazy):
+        if lazy:
+            return LazyResponse(body, self.encoding, self.fallback_encoding)
+        return parse_response(body, self.encoding, self.fallback_encoding)
+
+    def stream(self, api_request, chunk_size=65536, timeout=None):
+        """
+        Send a PayTrace API request and iterate over its response records.
+
+          api_request -- a subclass of PayTraceRequest
+          chunk_size  -- number of bytes to read from the connection at once
+          timeout     -- seconds to wait for the gateway, overriding the
+                         client's timeout
+
+        Return a generator of (key, value) pairs, one per record, read
+        from the connection as they arrive (see iter_records). Use this for
+        ExportTransaction and ExportBatch requests that may return many
+        megabytes of records. The request is sent when iteration starts.
+
+        Instruments are told about the call once the generator is exhausted
+        or closed; its CallTiming counts reading the body as 'transfer' and
+        splitting it into records as 'parse', but not the time spent by the
+        caller between records.
+
+        """
+        if not self.instruments:
+            yield from self._stream(api_request, chunk_size, timeout, None)
+            return
+
+        for instrument in self.instruments:
+            instrument.before_send(api_request)
+        timing = CallTiming(api_request)
+        try:
+            yield from self._stream(api_request, chunk_size, timeout, timing)
+        except GeneratorExit:
+            # The caller stopped reading; nothing went wrong.
+            if timing.outcome is None:
+                timing.finish('ok')
+            raise
+        except:
+            if timing.outcome is None:
+                timing.finish('send_error')
+            raise
+        finally:
+            for instrument in self.instruments:
+                instrument.after_send(api_request, timing)
+
+    def _stream(self, api_request, chunk_size, timeout, timing):
+        if self.scheduler is None:
+            yield from self._stream_now(
+                api_request, chunk_size, timeout, timing
+            )
+            return
+        self.scheduler.acquire(api_request)
+        try:
+            if timing is not None:
+                timing.mark('queue')
+            yield from self._stream_now(
+                api_request, chunk_size, timeout, timing
+            )
+        finally:
+            self.scheduler.release()
+
+    def _stream_now(self, api_request, chunk_size, timeout, timing):
+        utc_timestamp = '%s+00:00' % datetime.utcnow()
+        data = api_request.to_bytes(self.credentials)
+        if timing is not None:
+            timing.mark('serialize')
+            timing.bytes_sent = len(data)
+            _current_timing.timing = timing
+        try:
+            status_code, chunks = self.transport.post_stream(
+                self.post_url,
+                data,
+                self._timeout_for(api_request, timeout),
+                chunk_size,
+            )
+        except KeyboardInterrupt:
+            raise
+        except:
+            exc_class, exc_instance = sys.exc_info()[:2]
+            raise Exception(
+                'Error sending HTTP POST.',
+                {'exc_instance': exc_instance,
+                 'api_request': repr(api_request),
+                 'api_request_raw': data.decode('ascii'),
+                 'utc_timestamp': utc_timestamp}
+            )
+        finally:
+            _current_timing.timing = None
+        if timing is not None:
+            # post_stream returns once the response headers have arrived.
+            timing.mark('server')
+            timing.phases['server'] = max(0.0, timing.phases['server'] - sum(
+                timing.phases.get(phase, 0) for phase in ('connect', 'tls')
+            ))
+
+        if status_code != 200:
+            # Don't take an error page (often empty, e.g. from a restarting
+            # gateway) for an empty export.
+            try:
+                body = b''.join(islice(chunks, 1))[:100]
+            finally:
+                chunks.close()
+            if timing is not None:
+                timing.finish('parse_error')
+            exc_instance = UnexpectedResponseError(
+                'Unexpected HTTP status: %d' % status_code
+            )
+            raise Exception(
+                'Error parsing HTTP response.',
+                {'exc_instance': exc_instance,
+                 'api_request': repr(api_request),
+                 'api_request_raw': data.decode('ascii'),
+                 'api_response': body,
+                 'http_status': status_code,
+                 'utc_timestamp': utc_timestamp}
+            )
+
+        try:
+            if timing is None:
+                yield from iter_records(
+                    chunks, self.encoding, self.fallback_encoding
+                )
+            else:
+                yield from self._timed_records(chunks, timing)
+        except (KeyboardInterrupt, GeneratorExit):
+            raise
+        except:
+            exc_class, exc_instance = sys.exc_info()[:2]
+            if timing is not None:
+                timing.finish('parse_error')
+            raise Exception(
+                'Error parsing HTTP response.',
+                {'exc_instance': exc_instance,
+                 'api_request': repr(api_request),
+                 'api_request_raw': data.decode('ascii'),
+                 'http_status': status_code,
+                 'utc_timestamp': utc_timestamp}
+            )
+        finally:
+            chunks.close()
+
+    def _timed_records(self, chunks, timing):
+        phases = timing.phases
+        phases['transfer'] = phases['parse'] = 0.0
+
+        def timed_chunks():
+            for chunk in _timed_iter(chunks, phases, 'transfer'):
+                timing.bytes_received += len(chunk)
+                yield chunk
+
+        error = False
+        records = iter_records(
+            timed_chunks(), self.encoding, self.fallback_encoding
+        )
+        while True:
+            start = time.perf_counter()
+            transfer = phases['transfer']
+            record = next(records, None)
+            phases['parse'] += (
+                time.perf_counter() - start - (phases['transfer'] - transfer)
+            )
+            if record is None:
+                break
+            error = error or record[0] == 'ERROR'
+            yield record
+        timing.finish('error' if error else 'ok')
+
+    def send_many(self, api_requests, max_workers=None):
+        """
+        Send several PayTrace API requests in parallel.
+
+          api_requests -- an iterable of PayTraceRequest subclass instances
+          max_workers  -- number of requests in flight at once (defaults to
+                          the client's pool_maxsize, so every worker can
+                          hold a keep-alive connection)
+
+        Return a list of BatchResult tuples in the same order as
+        api_requests. A request that fails doesn't stop the others; its
+        exception is stored in the result instead.
+
+        """
+        if max_workers is None:
+            max_workers = self.pool_maxsize
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Run each request in a copy of the caller's context, so that
+            # use_credentials applies in the worker threads too.
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run,
+                    self._send_for_batch, api_request,
+                )
+                for api_request in api_requests
+            ]
+            return [future.result() for future in futures]
+
+    def _send_for_batch(self, api_request):
+        start = time.perf_counter()
+        try:
+            response = self.send(api_request)
+        except Exception as exc:
+            return BatchResult(
+                api_request, None, exc, time.perf_counter() - start
+            )
+        return BatchResult(
+            api_request, response, None, time.perf_counter() - start
+        )
+
+
+BatchResult = namedtuple(
+    'BatchResult', ['api_request', 'response', 'exception', 'elapsed']
+)
+BatchResult.__doc__ = """
+    The outcome of one request sent by PayTraceClient.send_many.
+
+      api_request -- the PayTraceRequest that was sent
+      response    -- the parsed response dictionary, or None on failure
+      exception   -- the exception raised while sending, or None on success
+      elapsed     -- seconds spent sending the request
+
+    """
+
+
+class AsyncPayTraceClient(object):
+    """
+    Send PayTrace API requests from asyncio code.
+
+    The asyncio counterpart of PayTraceClient (requires aiohttp). Requests
+    share one pool of keep-alive connections, and at most max_concurrency
+    of them are in flight at once; the rest wait their turn on a semaphore,
+    so any number of send() calls may be scheduled on one event loop.
+
+      post_url           -- the PayTrace API endpoint
+      timeout            -- seconds to wait for the gateway before giving up
+      max_concurrency    -- maximum number of requests in flight
+      pool_maxsize       -- maximum number of open connections (0 = no limit)
+      pool_maxsize_per_host -- maximum open connections per host (0 = no
+                              limit)
+      keepalive_timeout  -- seconds an idle connection is kept open
+      cache              -- an optional ResponseCache for export requests
+      credentials        -- the Credentials to send requests with (defaults
+                            to current_credentials() at the time of sending)
+      encoding           -- the encoding of response bodies
+      fallback_encoding  -- the encoding used for responses that aren't
+                            valid in encoding (see decode_response)
+
+    Use the client as an async context manager, or await close() when done.
+
+    Instruments added with add_instrument() are told about every call, as
+    with PayTraceClient; the 'connect' phase covers both the TCP connect
+    and the TLS handshake, and a 'queue' phase records time spent waiting
+    for the concurrency semaphore.
+
+    """
+    def __init__(self, post_url=POST_URL, timeout=60, max_concurrency=100,
+                 pool_maxsize=100, pool_maxsize_per_host=0,
+                 keepalive_timeout=15, cache=None, credentials=None,
+                 encoding=RESPONSE_ENCODING,
+                 fallback_encoding=FALLBACK_ENCODING):
+        if aiohttp is None:
+            raise ImportError('AsyncPayTraceClient requires aiohttp')
+        self.post_url = post_url
+        self.credentials = credentials
+        self.encoding = encoding
+        self.fallback_encoding = fallback_encoding
+        self.timeout = timeout
+        self.cache = cache
+        self.pool_maxsize = pool_maxsize
+        self.pool_maxsize_per_host = pool_maxsize_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.instruments = []
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Close all pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # aiohttp sessions must be created inside a running event loop.
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_maxsize,
+                limit_per_host=self.pool_maxsize_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_start.append(
+                self._on_connection_create_start
+            )
+            trace_config.on_connection_create_end.append(
+                self._on_connection_create_end
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace_config],
+            )
+        return self._session
+
+    @staticmethod
+    async def _on_connection_create_start(session, context, params):
+        timing = context.trace_request_ctx
+        if timing is not None:
+            timing.mark('server')
+
+    @staticmethod
+    async def _on_connection_create_end(session, context, params):
+        timing = context.trace_request_ctx
+        if timing is not None:
+            timing.mark('connect')
+
+    def add_instrument(self, instrument):
+        """Add an Instrument to be called around every request."""
+        self.instruments.append(instrument)
+
+    async def send(self, api_request, lazy=False):
+        """
+        Send a PayTrace API request and get a response.
+
+          api_request -- a subclass of PayTraceRequest
+          lazy        -- if True, return a LazyResponse instead of a dict
+
+        Return the PayTrace response parsed into a dictionary. Errors are
+        reported the same way as by PayTraceClient.send.
+
+        """
+        if not self.instruments:
+            return await self._send(api_request, lazy, None)
+
+        for instrument in self.instruments:
+            instrument.before_send(api_request)
+        timing = CallTiming(api_request)
+        try:
+            api_response_dict = await self._send(api_request, lazy, timing)
+        except:
+            if timing.outcome is None:
+                timing.finish('send_error')
+            raise
+        else:
+            timing.finish('error' if 'ERROR' in api_response_dict else 'ok')
+        finally:
+            for instrument in self.instruments:
+                instrument.after_send(api_request, timing)
+        return api_response_dict
+
+    _parse = PayTraceClient._parse
+
+    async def _send(self, api_request, lazy, timing):
+        utc_timestamp = '%s+00:00' % datetime.utcnow()
+        data = api_request.to_bytes(self.credentials)
+        if timing is not None:
+            timing.mark('serialize')
+            timing.bytes_sent = len(data)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(api_request, data)
+            body = cache_key and self.cache.get(cache_key)
+            if body:
+                return self._parse(body, lazy)
+        async with self._semaphore:
+            if timing is not None:
+                timing.mark('queue')
+            session = self._get_session()
+            try:
+                async with session.post(
+                    self.post_url, data=data, trace_request_ctx=timing
+                ) as response:
+                    if timing is not None:
+                        # Time before a new connection was opened is
+                        # recorded as 'server' too (see _on_connection_*).
+                        waiting = timing.phases.get('server', 0)
+                        timing.mark('server')
+                        timing.phases['server'] += waiting
+                    response_body = await response.read()
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                raise
+            except:
+                exc_class, exc_instance = sys.exc_info()[:2]
+                raise Exception(
+                    'Error sending HTTP POST.',
+                    {'exc_instance': exc_instance,
+                     'api_request': repr(api_request),
+                     'api_request_raw': data.decode('ascii'),
+                     'utc_timestamp': utc_timestamp}
+                )
+        if timing is not None:
+            timing.mark('transfer')
+            timing.bytes_received = len(response_body)
+
+        try:
+            api_response_dict = self._parse(response_body, lazy)
+        except KeyboardInterrupt:
+            raise
+        except:
+            exc_class, exc_instance = sys.exc_info()[:2]
+            if timing is not None:
+                timing.finish('parse_error')
+            raise Exception(
+                'Error parsing HTTP response.',
+                {'exc_instance': exc_instance,
+                 'api_request': repr(api_request),
+                 'api_request_raw': data.decode('ascii'),
+                 'api_response': response_body[:100],
+                 'http_status': response.status,
+                 'utc_timestamp': utc_timestamp}
+            )
+        if timing is not None:
+            timing.mark('parse')
+        if cache_key is not None and 'ERROR' not in api_response_dict:
+            self.cache.put(cache_key, api_request, response_body)
+
+        return api_response_dict
+
+
+# Default clients used by send_api_request, one per post_url.
+_default_clients = {}
+_default_clients_lock = threading.Lock()
+
+
+def get_default_client(post_url=POST_URL):
+    """Return the shared PayTraceClient used by send_api_request."""
+    try:
+        return _default_clients[post_url]
+    except KeyError:
+        with _default_clients_lock:
+            if post_url not in _default_clients:
+                _default_clients[post_url] = PayTraceClient(post_url)
+            return _default_clients[post_url]
+
+
+def send_api_request(api_request, post_url=POST_URL, lazy=False):
     """
     Send a PayTrace API request and get a response.
 
       api_request -- a subclass of PayTraceRequest
+      lazy        -- if True, return a read-only LazyResponse that decodes
+                     fields on demand instead of a dictionary
 
     See section 3.2.
 
+    The request is sent by the default PayTraceClient for post_url, so
+    connections to the gateway are reused between calls.
+
     Variable naming gets a little confusing here because both requests
     and PayTrace have a notion of "requests" and "responses". For clarity,
     you'll see
@@ -80,59 +1923,112 @@ def send_api_request(api_request, post_url=POST_URL):
         response.url
 
     """
-    utc_timestamp = '%s+00:00' % datetime.utcnow()
-    try:
-        response = requests.post(
-            post_url,
-            data=str(api_request),
-            headers={'Content-Type': 'application/x-www-form-urlencoded'},
-            timeout=60,
-        )
-    except KeyboardInterrupt:
-        raise
-    except:
-        exc_class, exc_instance = sys.exc_info()[:2]
-        raise Exception(
-            'Error sending HTTP POST.',
-            {'exc_instance': exc_instance,
-             'api_request': repr(api_request),
-             'api_request_raw': str(api_request),
-             'utc_timestamp': utc_timestamp}
-        )
+    return get_default_client(post_url).send(api_request, lazy)
 
-    try:
-        api_response_dict = parse_response(response.text)
-    except KeyboardInterrupt:
-        raise
-    except:
-        exc_class, exc_instance = sys.exc_info()[:2]
-        raise Exception(
-            'Error parsing HTTP response.',
-            {'exc_instance': exc_instance,
-             'api_request': repr(api_request),
-             'api_request_raw': str(api_request),
-             'api_response': response.text[:100],
-             'utc_timestamp': utc_timestamp}
-        )
 
-    return api_response_dict
+def stream_api_request(api_request, post_url=POST_URL, chunk_size=65536):
+    """
+    Send a PayTrace API request and iterate over its response records
+    without reading the whole response into memory. See
+    PayTraceClient.stream.
+
+    For example,
+
+        export = ExportTransaction(sdate='01/01/2013', edate='01/31/2013')
+        for key, value in stream_api_request(export):
+            if key == 'TRANSACTIONRECORD':
+                transaction = parse_record(value)
+
+    """
+    return get_default_client(post_url).stream(api_request, chunk_size)
+
+
+def send_many(api_requests, max_workers=10, post_url=POST_URL):
+    """
+    Send several PayTrace API requests in parallel and return a list of
+    BatchResult tuples in input order. See PayTraceClient.send_many.
+
+    """
+    return get_default_client(post_url).send_many(api_requests, max_workers)
 
 
 def uppercase_keys(d):
     """Change a dictionary in-place so that all keys are uppercase."""
-    for key in d:
+    for key in list(d):
         KEY = key.upper()
         if key != KEY:
             d[KEY] = d[key]
             del d[key]
 
 
+Credentials = namedtuple('Credentials', ['username', 'password', 'test_mode'])
+Credentials.__new__.__defaults__ = (False,)
+Credentials.__doc__ = """
+    The PayTrace account a request is sent for.
+
+      username  -- the account's user name (UN)
+      password  -- the account's password (PSWD)
+      test_mode -- if True, ProcessTranx requests are sent as test
+                   transactions (see set_test_mode)
+
+    Give a client its own credentials (PayTraceClient(credentials=...)), or
+    set them for a thread or task with use_credentials, to work for several
+    merchants at once in one process.
+
+    """
+
+# Credentials set by use_credentials for the current thread or task.
+_context_credentials = contextvars.ContextVar(
+    'paytrace_credentials', default=None
+)
+
+
+def current_credentials():
+    """
+    Return the Credentials requests are sent with when the client has none
+    of its own: those set by use_credentials in the current thread or task,
+    or else those set by set_credentials and set_test_mode.
+
+    """
+    credentials = _context_credentials.get()
+    if credentials is None:
+        credentials = Credentials(
+            PayTraceRequest.UN,
+            PayTraceRequest.PSWD,
+            PayTraceRequest._test_mode,
+        )
+    return credentials
+
+
+@contextmanager
+def use_credentials(credentials):
+    """
+    Send requests with credentials within a with block, in the current
+    thread or asyncio task only. For example,
+
+        with use_credentials(Credentials('merchant1', 'secret')):
+            send_api_request(sale)
+
+    Requests sent by send_many and export_transactions from within the
+    block use the credentials too.
+
+    """
+    token = _context_credentials.set(credentials)
+    try:
+        yield credentials
+    finally:
+        _context_credentials.reset(token)
+
+
 def set_credentials(username, password):
     """
     To use the PayTrace API, you need to supply the user name and password for
     a valid PayTrace account. For example, to use the PayTrace demo account,
     run set_credentials('demo123', 'demo123').
 
+    These are the default credentials for the whole process; see Credentials
+    for using several accounts at once.
+
     """
     PayTraceRequest.UN = username
     PayTraceRequest.PSWD = password
@@ -146,6 +2042,8 @@ def set_test_mode():
     with standardized test responses. Test transactions will not place a hold
     on the customer's credit card.
 
+    This enables test mode for the default credentials; see Credentials.
+
     """
     PayTraceRequest._test_mode = True
 
@@ -175,11 +2073,100 @@ class MetaRepr(type):
             return repr(cls)
 
 
+class MetaRequest(MetaRepr):
+    """
+    Compile each request class's field schema once, when the class is
+    created, instead of every time a request is instantiated.
+
+    The compiled schema is stored on the class as:
+
+      _constant_fields -- names of fields the class itself supplies (UN,
+                          PSWD, TERMS, METHOD, ...), sorted
+      _field_groups    -- a tuple of (conditional_field, needed, allowed)
+                          triples, one per _conditional entry (or a single
+                          triple with conditional_field None), where
+                          needed is the frozenset of required fields the
+                          caller must supply and allowed is the frozenset of
+                          all acceptable fields
+      _segments        -- the url-encoded segments of the constant fields,
+                          filled in by _serialize, keyed by a digest of
+                          the credentials and by test mode
+
+    Schema errors, such as overlapping _required and _optional fields, are
+    raised when the class is defined.
+
+    """
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        if cls._required is NotImplemented:
+            return  # abstract base class
+
+        cls._segments = {}
+        cls._constant_fields = tuple(
+            attr for attr in dir(cls)
+            if not attr.startswith('_') and not callable(getattr(cls, attr))
+        )
+        constants = frozenset(cls._constant_fields)
+        required = frozenset(cls._required)
+        optional = frozenset(cls._optional)
+
+        # Overlapping required and optional fields check.
+        if required & optional:
+            raise TypeError(
+                '{name}._required and {name}._optional must not overlap'
+                .format(**locals())
+            )
+
+        conditional = getattr(cls, '_conditional', None)
+        if conditional:
+            groups = [
+                (field, required | frozenset(field_list))
+                for field, field_list in conditional.items()
+            ]
+        else:
+            groups = [(None, required)]
+
+        field_groups = []
+        for field, group_required in groups:
+            allowed = group_required | optional
+            # Constant fields supplied by the class must be acceptable.
+            extra = ', '.join(sorted(constants - allowed))
+            if extra and cls._discretionary_data_allowed is not True:
+                if len(groups) > 1:
+                    # The constants rule out this set of conditional fields
+                    # (e.g., a template supplying TRANXID); try the others.
+                    continue
+                raise TypeError(
+                    '{name} defines extra fields: {extra}'.format(**locals())
+                )
+            field_groups.append(
+                (field, group_required - constants, allowed | constants)
+            )
+        if not field_groups:
+            raise TypeError(
+                '{name} defines fields from conflicting sets of conditional '
+                'fields'.format(**locals())
+            )
+        cls._field_groups = tuple(field_groups)
+
+
 #
 # Data definition classes
 #
 
-class PayTraceRequest(metaclass=MetaRepr):
+ValidationResult = namedtuple('ValidationResult', ['requests', 'errors'])
+ValidationResult.__doc__ = """
+    The outcome of validating rows with PayTraceRequest.validate_many.
+
+      requests -- a list with a request for each valid row and None for
+                  each invalid one, in row order
+      errors   -- a dict mapping the index of each invalid row to a list of
+                  its error messages
+
+    """
+
+
+class PayTraceRequest(metaclass=MetaRequest):
     """
     PayTrace request abstract base class.
 
@@ -194,6 +2181,7 @@ class PayTraceRequest(metaclass=MetaRepr):
     _required = NotImplemented
     _optional = NotImplemented
     _discretionary_data_allowed = NotImplemented
+    _allowed_values = {}
     _test_mode = False
 
     def __init__(self, **kwargs):
@@ -201,74 +2189,159 @@ class PayTraceRequest(metaclass=MetaRepr):
         Convert kwargs to uppercased instance attributes, assert all required
         fields are supplied, and verify that optional fields are acceptable.
 
-        """
-        assert self.UN and self.PSWD, (
-            'You first need to define UN and PSWD by running '
-            "set_credentials('username', 'password')"
-        )
+        Credentials (UN and PSWD) and test mode are added when the request
+        is serialized; see _serialize.
 
+        """
         # Normalize kwargs to uppercase.
         uppercase_keys(kwargs)
 
         # Add kwargs as uppercased instance attributes.
-        for key, value in kwargs.items():
-            setattr(self, key, str(value))
+        self.__dict__.update(
+            (key, str(value)) for key, value in kwargs.items()
+        )
 
-        # TEST is a special case allowed for all ProcessTranx transactions.
-        if self.METHOD == 'ProcessTranx' and PayTraceRequest._test_mode:
-            # If test mode has been enabled by running set_test_mode(),
-            # inject TEST here. All ProcessTranx requests will be submitted
-            # as test transactions.
-            self.TEST = 'Y'
+        # Schema and field value checks.
+        for error_class, message in self._schema_errors(kwargs.keys()):
+            raise error_class(message)
+        for message in self._value_errors(kwargs):
+            raise AssertionError(message)
 
-        fields = set(self._fields)
-        required = set(self._required)
-        optional = set(self._optional)
+    @classmethod
+    def _schema_errors(cls, fields):
+        """
+        Return a list of (exception class, message) pairs, one for each
+        way the set of uppercased field names breaks the class's schema.
 
-        name = self.__class__.__name__
+        """
+        name = cls.__name__
+        field_groups = cls._field_groups
+        errors = []
 
-        # Overlapping required and optional fields check.
-        assert not required & optional, (
-            '{name}._required and {name}._optional must not overlap'
-            .format(**locals())
-        )
-        # If conditional fields are defined, add at least one set to required.
-        self._required = self._required[:]
-        if hasattr(self, '_conditional'):
-            for field, field_list in self._conditional.items():
-                if field in kwargs:
-                    self._required += field_list
-                    required.update(field_list)
+        # If conditional fields are defined, at least one set is required.
+        if field_groups[0][0] is None:
+            needed, allowed = field_groups[0][1:]
+        else:
+            for field, needed, allowed in field_groups:
+                if field in fields or field in cls._constant_fields:
                     break
             else:
                 field_sets = '\n'.join(
                     '  {0}'.format(field_list)
-                    for field_list in self._conditional.values()
+                    for field_list in cls._conditional.values()
                 )
-                raise AssertionError(
+                errors.append((AssertionError, (
                     'One of the following sets of fields is required:\n'
                     '{field_sets}'
                     .format(field_sets=field_sets)
-                )
+                )))
+                needed = frozenset.intersection(*(
+                    group[1] for group in field_groups
+                ))
+                allowed = frozenset().union(*(
+                    group[2] for group in field_groups
+                ))
         # Missing fields check.
-        missing = ', '.join(required - fields)
+        missing = ', '.join(sorted(needed - fields))
         if missing:
-            raise KeyError(
+            errors.append((KeyError, (
                 '{name} has missing fields: {missing}'.format(**locals())
-            )
+            )))
         # Extra fields check.
-        extra = ', '.join(sorted(fields - required - optional))
+        extra = ', '.join(sorted(fields - allowed))
         if extra:
-            if self._discretionary_data_allowed is True:
+            if cls._discretionary_data_allowed is True:
                 # Extra fields found but discretionary data is allowed.
                 sys.stderr.write(
                     'Note: Extra fields found (ok if discretionary data): %s\n'
                     % extra
                 )
             else:
-                raise KeyError(
+                errors.append((KeyError, (
                     '{name} defines extra fields: {extra}'.format(**locals())
-                )
+                )))
+        return errors
+
+    @classmethod
+    def _value_errors(cls, kwargs):
+        """Return a message for each field value _allowed_values rejects."""
+        return [
+            'Invalid {0} value: {1!r} (allowed values: {2})'
+            .format(field, kwargs[field], list(values))
+            for field, values in cls._allowed_values.items()
+            if field in kwargs and kwargs[field] not in values
+        ]
+
+    @classmethod
+    def validate_many(cls, rows):
+        """
+        Validate many rows of fields at once and return a ValidationResult.
+
+          rows -- an iterable of dictionaries of fields (e.g., a
+                  csv.DictReader), or a dictionary of columns mapping each
+                  field name to a sequence of values
+
+        Unlike instantiating the class row by row, every error in every row
+        is reported. Field names may be in any case, and fields whose value
+        is None or '' are left out (so blank CSV cells are treated as not
+        supplied). The schema of each distinct set of field names is checked
+        only once, and requests for valid rows are built without going
+        through __init__, so this is much faster than instantiating the
+        class for each row.
+
+        For example,
+
+            with open('sales.csv', newline='') as f:
+                result = Sale.validate_many(csv.DictReader(f))
+            for index, messages in sorted(result.errors.items()):
+                print(index, messages)
+            send_many(request for request in result.requests if request)
+
+        """
+        if isinstance(rows, Mapping):
+            columns = list(rows)
+            rows = (
+                dict(zip(columns, values)) for values in zip(*rows.values())
+            )
+        check_values = cls._allowed_values and cls._value_errors
+
+        schema_errors = {}
+        requests, errors = [], {}
+        for index, row in enumerate(rows):
+            fields = dict(
+                (key.upper(), str(value)) for key, value in row.items()
+                if value is not None and value != ''
+            )
+            key = frozenset(fields)
+            messages = schema_errors.get(key)
+            if messages is None:
+                messages = schema_errors[key] = [
+                    message for _, message in cls._schema_errors(key)
+                ]
+            if check_values:
+                messages = messages + check_values(fields)
+            if messages:
+                errors[index] = list(messages)
+                requests.append(None)
+            else:
+                api_request = cls.__new__(cls)
+                api_request.__dict__.update(fields)
+                requests.append(api_request)
+        return ValidationResult(requests, errors)
+
+    @classmethod
+    def template(cls, **kwargs):
+        """
+        Return a RequestTemplate for requests of this class that share the
+        fields in kwargs. For example,
+
+            monthly = Sale.template(description='Monthly plan',
+                                    customdba='Example Co.')
+            sale = monthly(custid='customer1', amount='9.99',
+                           invoice='1001')
+
+        """
+        return RequestTemplate(cls, **kwargs)
 
     @classmethod
     def __classrepr__(cls):
@@ -310,36 +2383,179 @@ class PayTraceRequest(metaclass=MetaRepr):
         l.append(')\n')
         return '\n'.join(l)
 
-    @property
-    def _fields(self):
-        return [s for s in dir(self) if not s.startswith('_')]
+    @property
+    def _fields(self):
+        fields = set(self._constant_fields)
+        fields.update(s for s in self.__dict__ if not s.startswith('_'))
+        return sorted(fields)
+
+    def __str__(self):
+        """
+        Serialize into a PayTrace request string. For example,
+
+        PARMLIST=METHOD%7EProcessTranx%7CPSWD%7Edemo123%7CTERMS%7EY%7CTRANXID
+        %7E1539%7CTRANXTYPE%7EVoid%7CUN%7Edemo123%7C
+
+        See section 3.2.
+
+        """
+        return self._serialize()
+
+    def to_bytes(self, credentials=None):
+        """
+        Serialize into a PayTrace request body, ready to be POSTed as-is.
+
+          credentials -- the Credentials to send the request with (defaults
+                         to current_credentials())
+
+        """
+        return self._serialize(credentials).encode('ascii')
+
+    def _serialize(self, credentials=None):
+        # PARMLIST is url-encoded character by character, so it can be built
+        # from separately encoded KEY~VALUE| segments, sorted by key. The
+        # segments for the class's constant fields (including UN, PSWD and,
+        # in test mode, TEST) are encoded once per class and credential set
+        # and reused. They're cached on the class, so they go away with it
+        # (see RequestTemplate), keyed on a digest of the credentials so the
+        # password isn't kept in the key.
+        cls = self.__class__
+        fields = self.__dict__
+        credentials = credentials or _context_credentials.get()
+        if credentials is None:
+            username, password, test_mode = cls.UN, cls.PSWD, cls._test_mode
+        else:
+            username, password, test_mode = credentials
+        assert username and password, (
+            'You first need to define UN and PSWD by running '
+            "set_credentials('username', 'password') or by giving the "
+            'client Credentials'
+        )
+        # TEST is a special case allowed for all ProcessTranx transactions.
+        test = test_mode and cls.METHOD == 'ProcessTranx'
+        key = (
+            hashlib.sha256(
+                (username + '\0' + password).encode('utf-8')
+            ).digest(),
+            test,
+        )
+        try:
+            constants = cls._segments[key]
+        except KeyError:
+            values = dict(
+                (field, getattr(cls, field)) for field in cls._constant_fields
+            )
+            values.update(UN=username, PSWD=password)
+            if test:
+                values['TEST'] = 'Y'
+            constants = cls._segments[key] = tuple(
+                (field, quote_plus(field + '~' + value + '|'))
+                for field, value in values.items()
+            )
+        segments = [
+            (key, quote_plus(key + '~' + value + '|'))
+            for key, value in fields.items() if not key.startswith('_')
+        ]
+        if test:
+            # In test mode, all ProcessTranx requests are submitted as test
+            # transactions, whatever their own TEST field says.
+            segments = [item for item in segments if item[0] != 'TEST']
+            fields = fields.keys() - {'TEST'}
+        segments.extend(item for item in constants if item[0] not in fields)
+        segments.sort()
+        return 'PARMLIST=' + ''.join(segment for key, segment in segments)
+
+    def __repr__(self):
+        """
+        Output an interpretable repr. For example,
+
+        VoidRequest(**{'TRANXID': '1539', 'TRANXTYPE': 'Void',
+          'TERMS': 'Y', 'METHOD': 'ProcessTranx'})
+
+        UN and PSWD are left out: a request is sent with whichever
+        credentials the client or context supplies (see Credentials), so
+        the class's own would be misleading, and the password shouldn't
+        end up in error reports.
 
-    def __str__(self):
         """
-        Serialize into a PayTrace request string. For example,
+        d = dict(
+            (key, getattr(self, key)) for key in self._fields
+            if key not in ('UN', 'PSWD')
+        )
+        return '{self.__class__.__name__}(**{d})'.format(self=self, d=d)
 
-        PARMLIST=METHOD%7EProcessTranx%7CPSWD%7Edemo123%7CTERMS%7EY%7CTRANXID
-        %7E1539%7CTRANXTYPE%7EVoid%7CUN%7Edemo123%7C
 
-        See section 3.2.
+class RequestTemplate(object):
+    """
+    A factory of requests that share some fields, for building many
+    similar requests quickly (see PayTraceRequest.template).
 
-        """
-        items = ((key, getattr(self, key)) for key in self._fields)
-        params = '|'.join('~'.join(item) for item in items) + '|'
-        request_string = urlencode(dict(PARMLIST=params))
-        return request_string
+      request_class -- a subclass of PayTraceRequest
+      kwargs        -- the fields every request shares
 
-    def __repr__(self):
-        """
-        Output an interpretable repr. For example,
+    The shared fields become constant fields of a subclass of
+    request_class, so they are validated once, when the template is
+    created (raising TypeError if the class doesn't accept them), and
+    url-encoded once, the first time a request is serialized. Calling the
+    template with the remaining fields checks only those, caching the
+    verdict for each distinct set of field names, and builds the request
+    without going through __init__. It raises the same errors
+    instantiating the class would.
 
-        VoidRequest(**{'TRANXID': '1539', 'TRANXTYPE': 'Void',
-          'UN': 'demo123', 'PSWD': 'demo123', 'TERMS': 'Y',
-          'METHOD': 'ProcessTranx'})
+    Fields given when calling the template override shared ones.
 
+    """
+    def __init__(self, request_class, **kwargs):
+        uppercase_keys(kwargs)
+        shared = dict((key, str(value)) for key, value in kwargs.items())
+        for message in request_class._value_errors(shared):
+            raise AssertionError(message)
+        shared.update(
+            __module__=request_class.__module__,
+            __doc__=request_class.__doc__,
+        )
+        self.request_class = type(
+            request_class.__name__, (request_class,), shared
+        )
+        self._schema_errors = {}
+
+    def __call__(self, **kwargs):
+        """Return a request with the shared fields and kwargs."""
+        cls = self.request_class
+        fields = dict(
+            (key.upper(), str(value)) for key, value in kwargs.items()
+        )
+        names = frozenset(fields)
+        errors = self._schema_errors.get(names)
+        if errors is None:
+            errors = self._schema_errors[names] = cls._schema_errors(names)
+        for error_class, message in errors:
+            raise error_class(message)
+        if cls._allowed_values:
+            for message in cls._value_errors(fields):
+                raise AssertionError(message)
+        api_request = cls.__new__(cls)
+        api_request.__dict__.update(fields)
+        return api_request
+
+    def validate_many(self, rows):
         """
-        d = dict((key, getattr(self, key)) for key in self._fields)
-        return '{self.__class__.__name__}(**{d})'.format(self=self, d=d)
+        Validate rows of the remaining fields; see
+        PayTraceRequest.validate_many.
+
+        """
+        return self.request_class.validate_many(rows)
+
+    def __repr__(self):
+        return '{0}.template({1})'.format(
+            self.request_class.__bases__[0].__name__,
+            ', '.join(
+                '{0}={1!r}'.format(field.lower(), getattr(self.request_class,
+                                                          field))
+                for field in sorted(vars(self.request_class))
+                if not field.startswith('_')
+            ),
+        )
 
 
 #
@@ -484,10 +2700,7 @@ class ForcedSale(PayTraceRequest):
         'CC': ['CC', 'EXPMNTH', 'EXPYR'],
         'CUSTID': ['CUSTID']
     }
-    _optional = [
-        'UN', 'PSWD', 'TERMS', 'METHOD', 'TRANXTYPE', 'AMOUNT', 'SWIPE',
-        'APPROVAL', 'TEST'
-    ]
+    _optional = ['SWIPE', 'TEST']
 
 
 class Capture(PayTraceRequest):
@@ -538,11 +2751,7 @@ class CashAdvance(PayTraceRequest):
         'CASHADVANCE', 'PHOTOID', 'IDEXP', 'LAST4', 'BNAME', 'BADDRESS',
         'BADDRESS2', 'BCITY', 'BSTATE', 'BZIP'
     ]
-    _optional = [
-        'UN', 'PSWD', 'TERMS', 'METHOD', 'TRANXTYPE', 'AMOUNT', 'CC',
-        'EXPMNTH', 'EXPYR', 'CASHADVANCE', 'PHOTOID', 'IDEXP', 'LAST4',
-        'BNAME', 'BADDRESS', 'BADDRESS2', 'BCITY', 'BSTATE', 'BZIP', 'TEST'
-    ]
+    _optional = ['CC', 'EXPMNTH', 'EXPYR', 'TEST']
 
 
 class StoreAndForward(Sale):
@@ -638,13 +2847,9 @@ class EmailReceipt(PayTraceRequest):
         'CHECKID': ['CHECKID']
     }
     _optional = ['TRANXTYPE', 'CUSTID', 'USER', 'RETURNBIN', 'SEARCHTEXT']
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-        tranxtype = kwargs.get('TRANXTYPE')
-        if tranxtype:
-            assert tranxtype in ['SETTLED', 'PENDING', 'DECLINED']
+    _allowed_values = {
+        'TRANXTYPE': ('SETTLED', 'PENDING', 'DECLINED'),
+    }
 
 
 #
@@ -686,20 +2891,12 @@ class ExportTransaction(PayTraceRequest):
         'SDATE': ['SDATE', 'EDATE']
     }
     _optional = ['TRANXTYPE', 'CUSTID', 'USER', 'RETURNBIN', 'SEARCHTEXT']
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-
-        # Validate TRANXTYPE value.
-        allowed_tranxtypes = [
+    _allowed_values = {
+        'TRANXTYPE': (
             'Sale', 'Authorization', 'Str/Fwd', 'Refund', 'Void', 'Capture',
             'Force', 'SETTLED', 'PENDING', 'DECLINED'
-        ]
-        tranxtype = kwargs.get('TRANXTYPE')
-        assert tranxtype is None or tranxtype in allowed_tranxtypes, (
-            'Invalid TRANXTYPE value: %r (allowed values: %s)'
-            % (tranxtype, allowed_tranxtypes)
-        )
+        ),
+    }
 
 
 class ExportBatch(PayTraceRequest):
@@ -738,6 +2935,1402 @@ class SettleTranxRequest(PayTraceRequest):
     _optional = []
 
 
+#
+# Reconciling "Service Unavailable" responses
+#
+
+# Date format of SDATE and EDATE.
+DATE_FORMAT = '%m/%d/%Y'
+
+
+def is_service_unavailable(exc):
+    """
+    Return True if exc, raised by a client's send(), means the gateway
+    answered "Service Unavailable". The transaction may or may not have
+    been processed; see ExportTransaction and Reconciler.
+
+    """
+    if len(exc.args) != 2 or not isinstance(exc.args[1], dict):
+        return False
+    info = exc.args[1]
+    if info.get('http_status') == 503:
+        return True
+    api_response = info.get('api_response') or b''
+    if isinstance(api_response, str):
+        api_response = api_response.encode('utf-8', 'replace')
+    return b'service unavailable' in api_response.lower()
+
+
+ReconciliationResult = namedtuple(
+    'ReconciliationResult',
+    ['processed', 'safe_to_retry', 'unmatchable', 'errors']
+)
+ReconciliationResult.__doc__ = """
+    The outcome of Reconciler.reconcile.
+
+      processed     -- (api_request, record) pairs for transactions the
+                       gateway did process, with the matching export
+                       record parsed into a dictionary
+      safe_to_retry -- requests the gateway has no record of
+      unmatchable   -- requests without an INVOICE or CUSTREF, which can't
+                       be looked up
+      errors        -- exceptions raised by export queries that failed;
+                       the requests they covered are still pending
+
+    """
+
+
+class Reconciler(object):
+    """
+    Find out which "Service Unavailable" transactions really went through,
+    with as few ExportTransaction queries as possible.
+
+      client          -- the PayTraceClient to query with (defaults to the
+                         default client)
+      max_window_days -- the longest date range covered by one query
+
+    PayTrace support recommends querying ExportTransaction after a
+    "Service Unavailable" response (see ExportTransaction). When the
+    gateway restarts, many transactions fail at once, and one query per
+    transaction adds load just when the gateway is weakest. A Reconciler
+    collects the failed requests instead and resolves them together: one
+    date-windowed ExportTransaction per window, whose records are streamed
+    and matched locally by INVOICE, or by CUSTREF if there's no INVOICE.
+
+    For example,
+
+        reconciler = Reconciler(client)
+        for sale in sales:
+            reconciler.send(sale)  # None if the outcome is unknown
+        ...
+        result = reconciler.reconcile()
+        client.send_many(result.safe_to_retry)
+
+    Requests are matched on a unique INVOICE or CUSTREF, so include one in
+    every transaction you may need to reconcile. Each query covers a day
+    more on either side of the dates the requests were sent, in case the
+    gateway's date differs from ours (e.g., near midnight, in another
+    time zone).
+
+    """
+    def __init__(self, client=None, max_window_days=1):
+        self.client = client or get_default_client()
+        self.max_window_days = max_window_days
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, api_request, when=None):
+        """
+        Add a request whose outcome is unknown.
+
+          when -- the date (or datetime) the request was sent; today by
+                  default
+
+        """
+        if isinstance(when, datetime):
+            when = when.date()
+        with self._lock:
+            self._pending.append((when or date.today(), api_request))
+
+    def send(self, api_request, lazy=False):
+        """
+        Send api_request with the reconciler's client. If the gateway
+        answers "Service Unavailable", add the request to be reconciled
+        and return None; otherwise return the response (or raise) as
+        client.send does.
+
+        """
+        try:
+            return self.client.send(api_request, lazy)
+        except Exception as exc:
+            if not is_service_unavailable(exc):
+                raise
+            self.add(api_request)
+            return None
+
+    def _windows(self, dates):
+        """Group dates into (sdate, edate) windows, in date order."""
+        windows = []
+        for day in sorted(set(dates)):
+            if windows and (day - windows[-1][0]).days < self.max_window_days:
+                windows[-1][1] = day
+            else:
+                windows.append([day, day])
+        return windows
+
+    def reconcile(self):
+        """
+        Query the gateway for every pending request and return a
+        ReconciliationResult. Resolved requests are removed from the
+        reconciler; the requests in a window whose query fails stay
+        pending for the next call.
+
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+
+        processed, safe_to_retry, unmatchable, errors = [], [], [], []
+        by_date = defaultdict(list)
+        for when, api_request in pending:
+            if getattr(api_request, 'INVOICE', None) or \
+                    getattr(api_request, 'CUSTREF', None):
+                by_date[when].append(api_request)
+            else:
+                unmatchable.append(api_request)
+
+        for sdate, edate in self._windows(by_date):
+            window = [
+                (day, api_request)
+                for day in sorted(by_date) if sdate <= day <= edate
+                for api_request in by_date[day]
+            ]
+            waiting = defaultdict(list)
+            for day, api_request in window:
+                waiting[_match_key(api_request)].append(api_request)
+            try:
+                processed.extend(self._query(sdate, edate, waiting))
+            except Exception as exc:
+                # The gateway may still be unavailable; try again later.
+                errors.append(exc)
+                with self._lock:
+                    self._pending.extend(window)
+                continue
+            for api_requests in waiting.values():
+                safe_to_retry.extend(api_requests)
+
+        return ReconciliationResult(
+            processed, safe_to_retry, unmatchable, errors
+        )
+
+    def _query(self, sdate, edate, waiting):
+        """
+        Stream the export for one window, moving matched requests out of
+        waiting. Return a list of (api_request, record) pairs.
+
+        """
+        export = ExportTransaction(
+            sdate=(sdate - timedelta(days=1)).strftime(DATE_FORMAT),
+            edate=(edate + timedelta(days=1)).strftime(DATE_FORMAT),
+        )
+        found = []
+        # The window's requests may only be retried if the export says
+        # what's there: records, or "no transactions". Anything else means
+        # nothing was learned.
+        answered = False
+        for key, value in self.client.stream(export):
+            if key == 'ERROR':
+                if 'no transactions' in value.lower():
+                    answered = True
+                    continue
+                raise PayTraceError('ExportTransaction failed: %s' % value,
+                                    {'api_request': repr(export)})
+            if key != 'TRANSACTIONRECORD':
+                continue
+            answered = True
+            if not waiting:
+                continue
+            record = parse_record(value)
+            for field in ('INVOICE', 'CUSTREF'):
+                match_key = (field, record.get(field))
+                api_requests = waiting.get(match_key, ())
+                for api_request in api_requests:
+                    tranxtype = getattr(api_request, 'TRANXTYPE', None)
+                    if record.get('TRANXTYPE', tranxtype) == tranxtype:
+                        break
+                else:
+                    continue
+                api_requests.remove(api_request)
+                if not api_requests:
+                    del waiting[match_key]
+                found.append((api_request, record))
+                break
+        if not answered:
+            raise PayTraceError(
+                'ExportTransaction returned neither records nor an error',
+                {'api_request': repr(export)},
+            )
+        return found
+
+
+def _match_key(api_request):
+    """Return the (field, value) a request is matched on by Reconciler."""
+    invoice = getattr(api_request, 'INVOICE', None)
+    if invoice:
+        return ('INVOICE', invoice)
+    return ('CUSTREF', api_request.CUSTREF)
+
+
+#
+# Exporting large date ranges
+#
+
+def is_timeout(exc):
+    """
+    Return True if exc, raised by a client's send() or stream(), means the
+    gateway didn't answer (or finish answering) in time.
+
+    """
+    if len(exc.args) != 2 or not isinstance(exc.args[1], dict):
+        return False
+    exc_instance = exc.args[1].get('exc_instance')
+    if isinstance(exc_instance, (requests.Timeout, asyncio.TimeoutError,
+                                 urllib3.exceptions.TimeoutError)):
+        return True
+    # requests reports read timeouts while streaming as connection errors.
+    return (
+        isinstance(exc_instance, requests.ConnectionError) and
+        bool(exc_instance.args) and
+        isinstance(exc_instance.args[0], urllib3.exceptions.ReadTimeoutError)
+    )
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(value, DATE_FORMAT).date()
+
+
+def export_transactions(sdate, edate, client=None, shard_days=1,
+                        max_workers=4, timeout=None, **kwargs):
+    """
+    Export the transactions between sdate and edate (inclusive) as one
+    stream of records, fetching sub-ranges of the dates in parallel.
+
+      sdate, edate -- dates, datetimes or 'MM/DD/YYYY' strings
+      client       -- the PayTraceClient to use (defaults to the default
+                      client)
+      shard_days   -- number of days fetched by each ExportTransaction
+      max_workers  -- number of exports in flight at once
+      timeout      -- seconds to wait for each export (defaults to the
+                      client's timeout)
+      kwargs       -- other ExportTransaction fields (TRANXTYPE, CUSTID,
+                      SEARCHTEXT, ...)
+
+    Return a generator of TRANSACTIONRECORD records parsed into
+    dictionaries (see parse_record), in date-range order. A record is
+    yielded only the first time its TRANXID is seen. A sub-range that
+    times out is split in half and fetched again; a single day that times
+    out raises.
+
+    For example,
+
+        for record in export_transactions('01/01/2013', '01/31/2013'):
+            ...
+
+    """
+    if shard_days < 1:
+        raise ValueError('shard_days must be at least 1')
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    return _export_transactions(
+        _as_date(sdate), _as_date(edate), client or get_default_client(),
+        shard_days, max_workers, timeout, kwargs,
+    )
+
+
+def _export_transactions(sdate, edate, client, shard_days, max_workers,
+                         timeout, kwargs):
+
+    def fetch(start, end):
+        export = ExportTransaction(
+            sdate=start.strftime(DATE_FORMAT),
+            edate=end.strftime(DATE_FORMAT),
+            **kwargs
+        )
+        records = []
+        for key, value in client.stream(export, timeout=timeout):
+            if key == 'TRANSACTIONRECORD':
+                records.append(parse_record(value))
+            elif key == 'ERROR' and 'no transactions' not in value.lower():
+                raise PayTraceError('ExportTransaction failed: %s' % value,
+                                    {'api_request': repr(export)})
+        return records
+
+    shards = []
+    start = sdate
+    while start <= edate:
+        end = min(edate, start + timedelta(days=shard_days - 1))
+        shards.append((start, end))
+        start = end + timedelta(days=1)
+    shards.reverse()  # pop() from the front of the date range
+
+    seen = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        def submit(start, end):
+            # Fetch in a copy of the caller's context (see use_credentials).
+            return executor.submit(
+                contextvars.copy_context().run, fetch, start, end
+            )
+
+        # Futures in date-range order, submitted a little ahead of the
+        # one being waited for so that up to max_workers run at once.
+        in_flight = []
+        while shards or in_flight:
+            while shards and len(in_flight) < max_workers:
+                start, end = shards.pop()
+                in_flight.append(
+                    (start, end, submit(start, end))
+                )
+            start, end, future = in_flight.pop(0)
+            try:
+                records = future.result()
+            except Exception as exc:
+                if not is_timeout(exc) or start == end:
+                    for _, _, other in in_flight:
+                        other.cancel()
+                    raise
+                # Split the range in two and fetch both halves next.
+                middle = start + (end - start) // 2
+                after_middle = middle + timedelta(days=1)
+                in_flight[:0] = [
+                    (start, middle, submit(start, middle)),
+                    (after_middle, end, submit(after_middle, end)),
+                ]
+                continue
+            for record in records:
+                transaction_id = record.get('TRANXID')
+                if transaction_id is not None:
+                    if transaction_id in seen:
+                        continue
+                    seen.add(transaction_id)
+                yield record
+
+
+#
+# Local transaction store
+#
+
+def _record_date(record):
+    """Return the date of an export record's WHEN field, or None."""
+    when = record.get('WHEN', '').split(' ')[0]
+    try:
+        return datetime.strptime(when, DATE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+class TransactionStore(object):
+    """
+    A local SQLite copy of exported transactions and batches.
+
+      path   -- the SQLite database file (':memory:' for a throwaway store)
+      client -- the PayTraceClient used to sync (defaults to the default
+                client)
+
+    sync() fetches only what's new since the previous sync, using
+    export_transactions and ExportBatch, and the query methods then answer
+    from the local copy without contacting the gateway. Transactions are
+    indexed by TRANXID, date, CUSTID and BATCHNUMBER; batches by
+    BATCHNUMBER and date.
+
+    For example,
+
+        store = TransactionStore('paytrace.sqlite')
+        store.sync(start='01/01/2013')  # the first sync needs a start date
+        ...
+        store.sync()                    # later syncs pick up where it left
+        store.transactions(custid='customer1')
+
+    """
+    _schema = """
+        CREATE TABLE IF NOT EXISTS transactions (
+            tranxid TEXT PRIMARY KEY,
+            day TEXT,
+            custid TEXT,
+            batchnumber TEXT,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS transactions_day ON transactions (day);
+        CREATE INDEX IF NOT EXISTS transactions_custid
+            ON transactions (custid);
+        CREATE INDEX IF NOT EXISTS transactions_batchnumber
+            ON transactions (batchnumber);
+        CREATE TABLE IF NOT EXISTS batches (
+            batchnumber TEXT PRIMARY KEY,
+            day TEXT,
+            record TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS batches_day ON batches (day);
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path, client=None):
+        self.client = client or get_default_client()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.executescript(self._schema)
+
+    def close(self):
+        self._db.close()
+
+    @property
+    def watermark(self):
+        """The last date synced (which is synced again next time)."""
+        row = self._db.execute(
+            "SELECT value FROM sync_state WHERE name = 'watermark'"
+        ).fetchone()
+        return date.fromisoformat(row[0]) if row else None
+
+    def sync(self, start=None, until=None, **kwargs):
+        """
+        Fetch transactions and batches from the watermark (or start, for
+        the first sync) through until (default: today) and store them.
+
+        The watermark day itself is fetched again, since transactions may
+        have been added or settled since it was last synced. Extra kwargs
+        are passed on to export_transactions (shard_days, max_workers,
+        timeout). Return the number of transaction records stored.
+
+        If an export fails, PayTraceError (or the client's exception) is
+        raised and nothing is stored, so the next sync starts from the
+        same watermark.
+
+        """
+        start = self.watermark or start
+        if start is None:
+            raise ValueError('The first sync needs a start date')
+        start = _as_date(start)
+        until = _as_date(until or date.today())
+
+        rows = []
+        for record in export_transactions(start, until, self.client,
+                                          **kwargs):
+            day = _record_date(record)
+            rows.append((
+                record.get('TRANXID'),
+                day and day.isoformat(),
+                record.get('CUSTID'),
+                record.get('BATCHNUMBER'),
+                json.dumps(record),
+            ))
+
+        batches = []
+        day = start
+        while day <= until:
+            export = ExportBatch(sdate=day.strftime(DATE_FORMAT))
+            response = self.client.send(export)
+            error = response.get('ERROR')
+            if response.get('BATCHNUMBER'):
+                batches.append((
+                    response['BATCHNUMBER'],
+                    day.isoformat(),
+                    json.dumps(dict(response)),
+                ))
+            elif error is None or 'no batch' not in error.lower():
+                # Only "no batch" says there's nothing to store for the day;
+                # raise before the watermark moves past it.
+                raise PayTraceError(
+                    'ExportBatch failed: %s' % (error or dict(response)),
+                    {'api_request': repr(export)},
+                )
+            day += timedelta(days=1)
+
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO transactions VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            self._db.executemany(
+                'INSERT OR REPLACE INTO batches VALUES (?, ?, ?)', batches
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO sync_state "
+                "VALUES ('watermark', ?)", (until.isoformat(),)
+            )
+        return len(rows)
+
+    def _query(self, table, sdate=None, edate=None, **columns):
+        where, params = [], []
+        if sdate is not None:
+            where.append('day >= ?')
+            params.append(_as_date(sdate).isoformat())
+        if edate is not None:
+            where.append('day <= ?')
+            params.append(_as_date(edate).isoformat())
+        for column, value in sorted(columns.items()):
+            if value is not None:
+                where.append('%s = ?' % column)
+                params.append(value)
+        sql = 'SELECT record FROM %s' % table
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY day, rowid'
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def transactions(self, sdate=None, edate=None, custid=None,
+                     batchnumber=None):
+        """Return the stored transaction records matching all criteria."""
+        return self._query('transactions', sdate, edate, custid=custid,
+                           batchnumber=batchnumber)
+
+    def transaction(self, tranxid):
+        """Return the stored record for tranxid, or None."""
+        records = self._query('transactions', tranxid=str(tranxid))
+        return records[0] if records else None
+
+    def batches(self, sdate=None, edate=None, batchnumber=None):
+        """Return the stored batch records matching all criteria."""
+        return self._query('batches', sdate, edate, batchnumber=batchnumber)
+
+
+#
+# Columnar export results
+#
+
+def _cents(amount):
+    """Return a decimal AMOUNT string as integer cents (0 if empty)."""
+    amount = amount.strip().replace(',', '')
+    whole, _, fraction = amount.lstrip('+-').partition('.')
+    if (whole + fraction).isdigit() and len(fraction) <= 2:
+        cents = int(whole or 0) * 100 + int(fraction.ljust(2, '0'))
+        return -cents if amount.startswith('-') else cents
+    if not amount:
+        return 0
+    return int((Decimal(amount) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def _integer(value):
+    """Return value as an int, or -1 if it's empty or not numeric."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return -1
+
+
+class TransactionColumns(object):
+    """
+    Export records stored column by column in compact arrays, for totaling
+    large numbers of transactions.
+
+      tranxid      -- array of TRANXIDs (-1 if missing)
+      amount_cents -- array of AMOUNTs in integer cents
+      tranxtype    -- array of codes indexing the tranxtypes list
+      status       -- array of codes indexing the statuses list
+      day          -- array of WHEN dates as proleptic ordinals (0 if
+                      missing; see date.fromordinal)
+      batchnumber  -- array of BATCHNUMBERs (-1 if missing)
+
+    Amounts are never parsed as floats, so totals are exact. Each row
+    takes 36 bytes however long its strings are; other fields (CUSTID,
+    INVOICE, ...) aren't kept, so use TransactionStore for lookups.
+
+    The totals_by_* aggregates use NumPy when it's installed; to_numpy()
+    returns the columns as NumPy arrays without copying them.
+
+    For example,
+
+        columns = TransactionColumns.from_export('01/01/2013', '01/31/2013')
+        columns.total()
+        columns.totals_by_type()
+
+    """
+    def __init__(self, records=()):
+        self.tranxid = array('q')
+        self.amount_cents = array('q')
+        self.tranxtype = array('H')
+        self.status = array('H')
+        self.day = array('q')
+        self.batchnumber = array('q')
+        self.tranxtypes = []
+        self.statuses = []
+        self._codes = ({}, {})
+        self._days = {}
+        self.extend(records)
+
+    @classmethod
+    def from_export(cls, sdate, edate, client=None, **kwargs):
+        """
+        Return the columns of every transaction from sdate through edate,
+        fetched with export_transactions (see it for the kwargs).
+
+        """
+        return cls(export_transactions(sdate, edate, client, **kwargs))
+
+    def __len__(self):
+        return len(self.tranxid)
+
+    def _code(self, index, names, value):
+        codes = self._codes[index]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def _ordinal(self, when):
+        day = when.split(' ')[0]
+        ordinal = self._days.get(day)
+        if ordinal is None:
+            try:
+                ordinal = datetime.strptime(day, DATE_FORMAT).toordinal()
+            except ValueError:
+                ordinal = 0
+            self._days[day] = ordinal
+        return ordinal
+
+    def append(self, record):
+        """Add an export record (a dictionary; see parse_record)."""
+        self.extend((record,))
+
+    def extend(self, records):
+        """
+        Add export records (dictionaries; see parse_record). A record whose
+        AMOUNT isn't a number raises PayTraceError; the records before it
+        are kept.
+
+        """
+        code, ordinal = self._code, self._ordinal
+        tranxtypes, statuses = self.tranxtypes, self.statuses
+        add_tranxid, add_amount = self.tranxid.append, self.amount_cents.append
+        add_tranxtype, add_status = self.tranxtype.append, self.status.append
+        add_day, add_batchnumber = self.day.append, self.batchnumber.append
+        for row, record in enumerate(records, len(self.tranxid)):
+            get = record.get
+            try:
+                cents = _cents(get('AMOUNT', ''))
+            except (ArithmeticError, ValueError):
+                raise PayTraceError(
+                    'Invalid AMOUNT in row {0} (TRANXID {1}): {2!r}'.format(
+                        row, get('TRANXID'), get('AMOUNT')
+                    ),
+                    {'record': record},
+                )
+            add_tranxid(_integer(get('TRANXID')))
+            add_amount(cents)
+            add_tranxtype(code(0, tranxtypes, get('TRANXTYPE', '')))
+            add_status(code(1, statuses, get('STATUS', '')))
+            add_day(ordinal(get('WHEN', '')))
+            add_batchnumber(_integer(get('BATCHNUMBER')))
+
+    def row(self, i):
+        """Return row i as a dictionary of its decoded fields."""
+        day = self.day[i]
+        return {
+            'TRANXID': self.tranxid[i],
+            'AMOUNT_CENTS': self.amount_cents[i],
+            'TRANXTYPE': self.tranxtypes[self.tranxtype[i]],
+            'STATUS': self.statuses[self.status[i]],
+            'DAY': date.fromordinal(day) if day else None,
+            'BATCHNUMBER': self.batchnumber[i],
+        }
+
+    def total(self):
+        """Return the sum of all amounts, in cents."""
+        if numpy is not None and len(self):
+            return int(self._numpy(self.amount_cents).sum())
+        return sum(self.amount_cents)
+
+    def _totals(self, keys):
+        """Return a dict of the total amount for each distinct key."""
+        if numpy is not None and len(self):
+            keys = self._numpy(keys)
+            order = numpy.argsort(keys, kind='stable')
+            keys = keys[order]
+            starts = numpy.flatnonzero(
+                numpy.concatenate(([True], keys[1:] != keys[:-1]))
+            )
+            sums = numpy.add.reduceat(self._numpy(self.amount_cents)[order],
+                                      starts)
+            return dict(zip(keys[starts].tolist(), sums.tolist()))
+        totals = defaultdict(int)
+        for key, cents in zip(keys, self.amount_cents):
+            totals[key] += cents
+        return dict(totals)
+
+    def totals_by_type(self):
+        """Return total cents keyed by TRANXTYPE."""
+        totals = self._totals(self.tranxtype)
+        return dict((self.tranxtypes[code], cents)
+                    for code, cents in totals.items())
+
+    def totals_by_status(self):
+        """Return total cents keyed by STATUS."""
+        totals = self._totals(self.status)
+        return dict((self.statuses[code], cents)
+                    for code, cents in totals.items())
+
+    def totals_by_batch(self):
+        """Return total cents keyed by BATCHNUMBER (-1 if unbatched)."""
+        return self._totals(self.batchnumber)
+
+    def totals_by_day(self):
+        """Return total cents keyed by date (None if WHEN was missing)."""
+        totals = self._totals(self.day)
+        return dict((date.fromordinal(day) if day else None, cents)
+                    for day, cents in totals.items())
+
+    @staticmethod
+    def _numpy(column):
+        dtype = numpy.uint16 if column.typecode == 'H' else numpy.int64
+        return numpy.frombuffer(column, dtype=dtype)
+
+    def to_numpy(self):
+        """
+        Return a dict of the columns as NumPy arrays sharing the columns'
+        memory (so don't append rows while using them). The day column is
+        converted to datetime64[D] (NaT if WHEN was missing).
+
+        """
+        if numpy is None:
+            raise ImportError('TransactionColumns.to_numpy requires numpy')
+        columns = dict(
+            (name, self._numpy(getattr(self, name)))
+            for name in ('tranxid', 'amount_cents', 'tranxtype', 'status',
+                         'batchnumber')
+        )
+        epoch = date(1970, 1, 1).toordinal()
+        day = (self._numpy(self.day) - epoch).astype('datetime64[D]')
+        day[self._numpy(self.day) == 0] = numpy.datetime64('NaT')
+        columns['day'] = day
+        return columns
+
+
+#
+# Outbound journal
+#
+
+class OutboundJournal(object):
+    """
+    A durable, append-only SQLite journal of requests sent to the gateway
+    and their outcomes, so that a crashed worker can tell what it sent.
+
+      path   -- the SQLite database file
+      client -- the PayTraceClient to send with (defaults to the default
+                client)
+
+    send() records a request durably before sending it, then records the
+    response. After a crash, replay() resolves the requests recorded
+    without a response: it looks those with an INVOICE or CUSTREF up with
+    a Reconciler (see ExportTransaction) and sends only the ones the
+    gateway has no record of again. Captures and Voids of a TRANXID are
+    simply sent again, since the gateway refuses to capture or void a
+    transaction twice.
+
+    The journal uses SQLite's write-ahead log, and requests recorded by
+    several threads at once share one commit (and fsync): the first
+    thread to arrive writes the waiting requests of all the others. So
+    senders can journal at a high rate without one disk sync per
+    request. Responses are written with the next commit (or flush()); one
+    lost in a crash only means the request is looked up by replay().
+
+    Fields are journaled without UN and PSWD, but with the user name and
+    test mode of the account they're sent for (the client's credentials or
+    current_credentials()), and each request is replayed as that account
+    only; see replay().
+
+    Card data is never journaled in full: CSC, SWIPE (track data) and
+    CUSTPSWD are left out, and CC and DDA account numbers keep only their
+    last four digits. A request with any of them can't be sent again from
+    the journal, so it's journaled as reconcile-only: replay() looks it up
+    but never resends it.
+
+    For example,
+
+        journal = OutboundJournal('outbound.sqlite', client)
+        journal.replay()  # at startup
+        ...
+        journal.send(Capture(tranxid='1539'))
+
+    """
+    _schema = """
+        CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY,
+            request_class TEXT NOT NULL,
+            fields TEXT NOT NULL,
+            day TEXT NOT NULL,
+            outcome TEXT,
+            response TEXT,
+            username TEXT,
+            test_mode INTEGER,
+            reconcile_only INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS journal_pending ON journal (outcome)
+            WHERE outcome IS NULL;
+    """
+    _resend_tranxtypes = frozenset(['Capture', 'Void'])
+    # Card and account data that must not be kept (PCI DSS), and account
+    # numbers that are kept masked.
+    _unjournaled_fields = frozenset(['CSC', 'SWIPE', 'CUSTPSWD'])
+    _masked_fields = frozenset(['CC', 'DDA'])
+
+    def __init__(self, path, client=None):
+        self.client = client or get_default_client()
+        self.commits = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        with self._db:
+            self._db.executescript(self._schema)
+            # Journals written before accounts were recorded; their
+            # entries are never replayed (see replay).
+            columns = set(
+                row[1] for row in
+                self._db.execute('PRAGMA table_info(journal)')
+            )
+            for column, column_type in (
+                    ('username', 'TEXT'),
+                    ('test_mode', 'INTEGER'),
+                    ('reconcile_only', 'INTEGER NOT NULL DEFAULT 0')):
+                if column not in columns:
+                    self._db.execute(
+                        'ALTER TABLE journal ADD COLUMN {0} {1}'.format(
+                            column, column_type
+                        )
+                    )
+        self._db_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._committing = False
+        self._entries = []  # [row, entry id, exception] lists to insert
+        self._acks = []     # (outcome, response, entry id) to update
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _row(self, api_request):
+        for cls in type(api_request).__mro__:
+            if globals().get(cls.__name__) is cls:
+                break
+        else:
+            raise TypeError(
+                'Cannot journal {0!r}'.format(type(api_request).__name__)
+            )
+        fields = {}
+        reconcile_only = False
+        for field in api_request._fields:
+            value = getattr(api_request, field)
+            if field in ('UN', 'PSWD'):
+                continue
+            if field in self._unjournaled_fields:
+                reconcile_only = reconcile_only or bool(value)
+                continue
+            if field in self._masked_fields and value:
+                value = '*' * max(0, len(value) - 4) + value[-4:]
+                reconcile_only = True
+            fields[field] = value
+        credentials = self.client.credentials or current_credentials()
+        return (
+            cls.__name__, json.dumps(fields), date.today().isoformat(),
+            credentials.username, int(bool(credentials.test_mode)),
+            int(reconcile_only),
+        )
+
+    def _group_commit(self, entries):
+        """
+        Wait until entries (and any others waiting) are committed, writing
+        them all in one transaction if no other thread is doing so.
+
+        """
+        with self._cond:
+            self._entries.extend(entries)
+            while any(entry[1] is None and entry[2] is None
+                      for entry in entries):
+                if self._committing:
+                    self._cond.wait()
+                    continue
+                self._committing = True
+                batch, self._entries = self._entries, []
+                acks, self._acks = self._acks, []
+                self._cond.release()
+                try:
+                    self._commit(batch, acks)
+                except Exception as exc:
+                    for entry in batch:
+                        entry[2] = exc
+                finally:
+                    self._cond.acquire()
+                    self._committing = False
+                    self._cond.notify_all()
+        for entry in entries:
+            if entry[2] is not None:
+                raise entry[2]
+        return [entry[1] for entry in entries]
+
+    def _commit(self, batch, acks):
+        with self._db_lock, self._db:
+            for entry in batch:
+                entry[1] = self._db.execute(
+                    'INSERT INTO journal (request_class, fields, day, '
+                    'username, test_mode, reconcile_only) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', entry[0]
+                ).lastrowid
+            self._db.executemany(
+                'UPDATE journal SET outcome = ?, response = ? WHERE id = ?',
+                acks,
+            )
+            self.commits += 1
+
+    def record(self, api_request):
+        """
+        Durably record that api_request is about to be sent and return its
+        journal entry id.
+
+        """
+        return self._group_commit([[self._row(api_request), None, None]])[0]
+
+    def record_many(self, api_requests):
+        """Record several requests in one commit; return their entry ids."""
+        return self._group_commit(
+            [[self._row(api_request), None, None]
+             for api_request in api_requests]
+        )
+
+    def acknowledge(self, entry_id, outcome, response=None):
+        """
+        Record the outcome of a journaled request: 'ok' with the gateway's
+        response, 'reconciled' with its export record, or e.g. 'abandoned'
+        to stop replay() from resolving it. It's written with the next
+        commit.
+
+        """
+        with self._cond:
+            self._acks.append((
+                outcome,
+                None if response is None else json.dumps(dict(response)),
+                entry_id,
+            ))
+
+    def flush(self):
+        """Write any outstanding acknowledgements now."""
+        with self._cond:
+            acks, self._acks = self._acks, []
+        if acks:
+            self._commit([], acks)
+
+    def send(self, api_request, lazy=False):
+        """
+        Journal api_request, send it with the journal's client and record
+        the response. If sending raises, the entry is left for replay().
+
+        """
+        entry_id = self.record(api_request)
+        response = self.client.send(api_request, lazy)
+        self.acknowledge(entry_id, 'ok', response)
+        return response
+
+    def send_many(self, api_requests, max_workers=None):
+        """
+        Journal api_requests in one commit, then send them as
+        PayTraceClient.send_many does and record the responses.
+
+        """
+        api_requests = list(api_requests)
+        entry_ids = self.record_many(api_requests)
+        results = self.client.send_many(api_requests, max_workers)
+        for entry_id, result in zip(entry_ids, results):
+            if result.exception is None:
+                self.acknowledge(entry_id, 'ok', result.response)
+        return results
+
+    def pending(self):
+        """
+        Return the journaled requests without an outcome, each with its
+        entry id as _journal_id, the date it was recorded as _journal_day,
+        its account as _journal_account, a (username, test_mode) pair, and
+        whether it was journaled without its card data as
+        _journal_reconcile_only.
+
+        """
+        with self._db_lock:
+            rows = self._db.execute(
+                'SELECT id, request_class, fields, day, username, test_mode, '
+                'reconcile_only FROM journal WHERE outcome IS NULL ORDER BY id'
+            ).fetchall()
+        api_requests = []
+        for (entry_id, class_name, fields, day, username, test_mode,
+             reconcile_only) in rows:
+            cls = globals()[class_name]
+            api_request = cls.__new__(cls)
+            api_request.__dict__.update(json.loads(fields))
+            api_request._journal_id = entry_id
+            api_request._journal_day = date.fromisoformat(day)
+            api_request._journal_account = (username, bool(test_mode))
+            api_request._journal_reconcile_only = bool(reconcile_only)
+            api_requests.append(api_request)
+        return api_requests
+
+    def replay(self, resend=True, credentials=None):
+        """
+        Resolve the pending requests (see pending) and return a
+        ReconciliationResult.
+
+          resend      -- if True, send requests the gateway has no record
+                         of again
+          credentials -- the Credentials of the accounts to replay, as a
+                         dict keyed by user name or a list (defaults to
+                         those the client sends with now)
+
+        Requests the gateway processed are acknowledged as 'reconciled'.
+        If resend is True, those it has no record of, and Captures and
+        Voids, are sent again, and acknowledged if that succeeds; the
+        exceptions of those that fail again are added to errors. Requests
+        that can't be looked up (unmatchable), and reconcile-only requests
+        in safe_to_retry (whose card data wasn't journaled), are left
+        pending; send or acknowledge them yourself.
+
+        Each request is looked up and sent again as the account it was
+        journaled for. Requests of an account whose credentials aren't
+        given, or were given with another test mode, are refused: they're
+        left pending and returned in unmatchable, with a PayTraceError in
+        errors for each such account. A client with credentials of its own
+        can only replay requests of that account.
+
+        """
+        if self.client.credentials is not None:
+            accounts = {
+                self.client.credentials.username: self.client.credentials
+            }
+        elif credentials is None:
+            current = current_credentials()
+            accounts = {current.username: current}
+        elif isinstance(credentials, Mapping):
+            accounts = dict(credentials)
+        else:
+            accounts = dict(
+                (account.username, account) for account in credentials
+            )
+
+        by_account = OrderedDict()
+        for api_request in self.pending():
+            by_account.setdefault(
+                api_request._journal_account, []
+            ).append(api_request)
+
+        processed, safe_to_retry, unmatchable, errors = [], [], [], []
+        for (username, test_mode), api_requests in by_account.items():
+            account = accounts.get(username)
+            if not username or account is None or \
+                    bool(account.test_mode) != test_mode:
+                unmatchable.extend(api_requests)
+                errors.append(PayTraceError(
+                    'No credentials to replay the requests of {0!r}{1} '
+                    'with'.format(
+                        username, ' in test mode' if test_mode else ''
+                    ),
+                    {'entry_ids': [
+                        api_request._journal_id
+                        for api_request in api_requests
+                    ]},
+                ))
+                continue
+            with use_credentials(account):
+                result = self._replay(api_requests, resend)
+            processed.extend(result.processed)
+            safe_to_retry.extend(result.safe_to_retry)
+            unmatchable.extend(result.unmatchable)
+            errors.extend(result.errors)
+        self.flush()
+        return ReconciliationResult(
+            processed, safe_to_retry, unmatchable, errors
+        )
+
+    def _replay(self, api_requests, resend):
+        """Replay the pending requests of one account."""
+        reconciler = Reconciler(self.client)
+        safe_to_retry = []
+        for api_request in api_requests:
+            if api_request.__dict__.get('TRANXTYPE') in \
+                    self._resend_tranxtypes and \
+                    api_request.__dict__.get('TRANXID'):
+                safe_to_retry.append(api_request)
+            else:
+                reconciler.add(api_request, api_request._journal_day)
+        result = reconciler.reconcile()
+
+        for api_request, record in result.processed:
+            self.acknowledge(api_request._journal_id, 'reconciled', record)
+        safe_to_retry.extend(result.safe_to_retry)
+        errors = list(result.errors)
+        resendable = [
+            api_request for api_request in safe_to_retry
+            if not api_request._journal_reconcile_only
+        ]
+        if resend and resendable:
+            for batch_result in self.client.send_many(resendable):
+                api_request = batch_result.api_request
+                if batch_result.exception is None:
+                    self.acknowledge(api_request._journal_id, 'ok',
+                                     batch_result.response)
+                else:
+                    errors.append(batch_result.exception)
+        return ReconciliationResult(
+            result.processed, safe_to_retry, result.unmatchable, errors
+        )
+
+
+#
+# Bulk file pipeline
+#
+
+# Fields echoed from each input row into the pipeline's output.
+_ECHO_FIELDS = ('INVOICE', 'CUSTREF', 'CUSTID', 'AMOUNT')
+
+
+def _read_rows(path, format=None):
+    """Yield the rows of a CSV or JSON lines file as dictionaries."""
+    if format is None:
+        format = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    with open(path, newline='') as f:
+        if format == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _recover_jsonl(path):
+    """
+    Return the objects in a JSON lines file written by an earlier run,
+    first truncating a last line left incomplete by a crash.
+
+    """
+    try:
+        with open(path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+    except FileNotFoundError:
+        return []
+    return [json.loads(line) for line in data[:end].splitlines()]
+
+
+def _write_jsonl(f, obj):
+    f.write(json.dumps(obj, sort_keys=True) + '\n')
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def run_pipeline(input_path, output_path, request_class=Sale,
+                 checkpoint_path=None, client=None, max_workers=10,
+                 batch_size=None, format=None):
+    """
+    Validate and send a request for every row of a CSV or JSON lines file
+    (e.g., CUSTID and AMOUNT for recurring billing), writing the outcome
+    of each row to a JSON lines output file.
+
+      input_path      -- the CSV or JSON lines (.jsonl) input file
+      output_path     -- the JSON lines output file, appended to
+      request_class   -- the ProcessTranx request class each row is for
+      checkpoint_path -- where sent rows are recorded (defaults to
+                         output_path + '.checkpoint')
+      client          -- the PayTraceClient to send with (defaults to the
+                         default client)
+      max_workers     -- number of requests in flight at once
+      batch_size      -- rows validated and checkpointed at a time
+                         (defaults to 10 * max_workers)
+      format          -- 'csv' or 'jsonl' (defaults to guessing from the
+                         input file name)
+
+    Each output line has the row's index, its INVOICE, CUSTREF, CUSTID and
+    AMOUNT, and a status:
+
+      sent        -- the gateway answered; see response
+      error       -- the gateway answered with an ERROR; see response
+      invalid     -- the row was not sent; see errors
+      processed   -- the gateway had processed the row when an earlier
+                     attempt's outcome was unknown; see record
+      unknown     -- the row was sent but the outcome can't be looked up
+                     because it has no INVOICE or CUSTREF
+
+    Before a batch is sent, its rows are recorded in the checkpoint and
+    synced to disk. If the run is interrupted, running it again with the
+    same files skips the rows already in the output, and rows that were
+    sent without an answer being written aren't sent again blindly: they
+    are looked up with a Reconciler, by INVOICE or CUSTREF, and only sent
+    again if the gateway has no record of them. Requests that fail without
+    an answer (e.g., "Service Unavailable" or a timeout) are resolved the
+    same way at the end of the run. Give every row a unique INVOICE so
+    that it can be.
+
+    Return a Counter of output statuses. Rows whose outcome is still
+    unknown (because the gateway couldn't be queried) are counted as
+    'unresolved' and left out of the output; run the pipeline again to
+    resolve them.
+
+    """
+    client = client or get_default_client()
+    if checkpoint_path is None:
+        checkpoint_path = output_path + '.checkpoint'
+    if batch_size is None:
+        batch_size = 10 * max_workers
+    input_path = os.path.abspath(input_path)
+
+    done = set(entry['row'] for entry in _recover_jsonl(output_path))
+    entries = _recover_jsonl(checkpoint_path)
+    if entries and entries[0].get('input') != input_path:
+        raise ValueError(
+            '{0} is the checkpoint of {1}'.format(
+                checkpoint_path, entries[0].get('input')
+            )
+        )
+    sent = dict(
+        (entry['row'], date.fromisoformat(entry['date']))
+        for entry in entries[1:] if entry['row'] not in done
+    )
+
+    counts = Counter()
+    reconciler = Reconciler(client)
+    in_doubt = {}  # id(api_request) -> (index, row)
+
+    with open(output_path, 'a') as output, \
+            open(checkpoint_path, 'a') as checkpoint:
+
+        def write(index, row, status, **fields):
+            row = dict((key.upper(), value) for key, value in row.items())
+            fields.update(row=index, status=status)
+            fields.update(
+                (field, row[field]) for field in _ECHO_FIELDS if field in row
+            )
+            _write_jsonl(output, fields)
+            counts[status] += 1
+
+        def send(batch):
+            today = date.today().isoformat()
+            for index, row, api_request in batch:
+                _write_jsonl(checkpoint, {'row': index, 'date': today})
+            _sync(checkpoint)
+            results = client.send_many(
+                [api_request for _, _, api_request in batch], max_workers
+            )
+            for (index, row, api_request), result in zip(batch, results):
+                if result.exception is not None:
+                    in_doubt[id(api_request)] = (index, row)
+                    reconciler.add(api_request)
+                else:
+                    response = dict(result.response)
+                    status = 'error' if 'ERROR' in response else 'sent'
+                    write(index, row, status, response=response)
+            _sync(output)
+
+        if not entries:
+            _write_jsonl(checkpoint, {'input': input_path})
+            _sync(checkpoint)
+
+        rows = enumerate(_read_rows(input_path, format))
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                break
+            chunk = [(index, row) for index, row in chunk if index not in done]
+            validation = request_class.validate_many(row for _, row in chunk)
+            batch = []
+            for position, (index, row) in enumerate(chunk):
+                api_request = validation.requests[position]
+                if api_request is None:
+                    write(index, row, 'invalid',
+                          errors=validation.errors[position])
+                elif index in sent:
+                    # Sent by an earlier run that didn't record the answer.
+                    in_doubt[id(api_request)] = (index, row)
+                    reconciler.add(api_request, sent[index])
+                else:
+                    batch.append((index, row, api_request))
+            if batch:
+                send(batch)
+
+        if reconciler:
+            result = reconciler.reconcile()
+            for api_request, record in result.processed:
+                index, row = in_doubt.pop(id(api_request))
+                write(index, row, 'processed', record=record)
+            for api_request in result.unmatchable:
+                index, row = in_doubt.pop(id(api_request))
+                write(index, row, 'unknown')
+            retry = [
+                in_doubt.pop(id(api_request)) + (api_request,)
+                for api_request in result.safe_to_retry
+            ]
+            if retry:
+                send(retry)
+            _sync(output)
+
+    if in_doubt:
+        counts['unresolved'] = len(in_doubt)
+    return counts
+
+
+# Request classes the pipeline can send, by name.
+_PIPELINE_CLASSES = dict(
+    (cls.__name__, cls) for cls in (
+        Sale, Authorization, Refund, Void, ForcedSale, Capture, CashAdvance,
+        StoreAndForward,
+    )
+)
+
+
+def main(argv=None):
+    """Run the bulk file pipeline (see run_pipeline) from the command line."""
+    parser = argparse.ArgumentParser(
+        prog='python -m paytrace',
+        description='Send a PayTrace request for every row of a CSV or '
+                    'JSON lines file. Run it again with the same files to '
+                    'resume an interrupted run.',
+        epilog='Credentials are read from the PAYTRACE_USERNAME and '
+               'PAYTRACE_PASSWORD environment variables.',
+    )
+    parser.add_argument('input', help='CSV or JSON lines (.jsonl) rows')
+    parser.add_argument('output', help='JSON lines results, appended to')
+    parser.add_argument('--type', default='Sale',
+                        choices=sorted(_PIPELINE_CLASSES),
+                        help='request class of every row (default: Sale)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='input format (default: from the file name)')
+    parser.add_argument('--checkpoint',
+                        help='checkpoint file (default: OUTPUT.checkpoint)')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='requests in flight at once (default: 10)')
+    parser.add_argument('--post-url', default=POST_URL,
+                        help='gateway URL (default: %(default)s)')
+    parser.add_argument('--test', action='store_true',
+                        help='submit transactions in test mode')
+    args = parser.parse_args(argv)
+
+    username = os.environ.get('PAYTRACE_USERNAME')
+    password = os.environ.get('PAYTRACE_PASSWORD')
+    if not (username and password):
+        parser.error('PAYTRACE_USERNAME and PAYTRACE_PASSWORD must be set')
+    set_credentials(username, password)
+    if args.test:
+        set_test_mode()
+
+    with PayTraceClient(args.post_url, pool_maxsize=args.workers) as client:
+        counts = run_pipeline(
+            args.input, args.output, _PIPELINE_CLASSES[args.type],
+            checkpoint_path=args.checkpoint, client=client,
+            max_workers=args.workers, format=args.format,
+        )
+    for status, count in sorted(counts.items()):
+        sys.stderr.write('{0:<12} {1}\n'.format(status, count))
+    if counts['unresolved']:
+        sys.stderr.write('Some outcomes are unknown; run again to resolve '
+                         'them.\n')
+        return 1
+    return 0
+
+
 def _test():
     """
     Send Authorization and Void requests to the PayTrace demo account using
@@ -839,6 +4432,8 @@ def _test():
     """.format(**locals()))
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
     print("""
     To explore the API, run 'python3 -i paytrace.py', then call the _test()
     function. By default, credentials for the PayTrace demo account are in
@@ -0,0 +1,440 @@
+"""
+Local PayTrace gateway simulator for load testing.
+
+GatewaySimulator is an HTTP server that accepts PARMLIST POSTs exactly as
+the paytrace module sends them, dispatches on METHOD and TRANXTYPE, and
+answers with KEY~VALUE| framed responses modelled on the PayTrace API
+(see section 5). It can approve, decline and partially approve
+transactions, export large numbers of transaction records, fail with
+"Service Unavailable", and add latency, so client throughput and tail
+latency can be measured without touching the real gateway.
+
+For example,
+
+    with GatewaySimulator(latency=0.05, unavailable_rate=0.01) as simulator:
+        client = paytrace.PayTraceClient(simulator.post_url)
+        response = client.send(paytrace.Void(tranxid='1539'))
+
+or, from the command line,
+
+    python3 paytrace_simulator.py --port 8080 --latency 0.05
+
+The server runs on its own asyncio event loop in a background thread and
+keeps connections alive, so it sustains thousands of requests per second.
+
+"""
+
+import argparse
+import asyncio
+import itertools
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from urllib.parse import unquote_plus
+
+
+SERVICE_UNAVAILABLE = (
+    b'HTTP/1.1 503 Service Unavailable\r\n'
+    b'Content-Type: text/html\r\n'
+    b'Content-Length: 19\r\n'
+    b'\r\n'
+    b'Service Unavailable'
+)
+
+# Successful ProcessTranx responses, by TRANXTYPE.
+PROCESSED = {
+    'Sale': '101. Your transaction was successfully approved.',
+    'Authorization': '101. Your transaction was successfully approved.',
+    'Force': '101. Your transaction was successfully approved.',
+    'Str/FWD': '125. Your transaction was successfully stored.',
+    'Refund': '106. Your transaction was successfully refunded.',
+    'Void': '109. Your transaction was successfully voided.',
+    'Capture': '112. Your transaction was successfully captured.',
+}
+DECLINED = '102. Your transaction was not approved.'
+PARTIALLY_APPROVED = '104. Your transaction was partially approved.'
+
+
+def parse_parmlist(body):
+    """Parse a PARMLIST=... request body into a dictionary of fields."""
+    body = body.decode('ascii')
+    if not body.startswith('PARMLIST='):
+        raise ValueError('Missing PARMLIST')
+    parmlist = unquote_plus(body[len('PARMLIST='):])
+    if not parmlist.endswith('|'):
+        raise ValueError('PARMLIST must end with |')
+    return dict(field.split('~', 1) for field in parmlist[:-1].split('|'))
+
+
+def _parse_date(mmddyyyy):
+    return datetime.strptime(mmddyyyy, '%m/%d/%Y').date()
+
+
+def format_response(fields):
+    """Frame a list of (key, value) pairs as a PayTrace response."""
+    return ''.join(
+        '{0}~{1}|'.format(key, value) for key, value in fields
+    ).encode('utf-8')
+
+
+class GatewaySimulator(object):
+    """
+    A local stand-in for the PayTrace gateway.
+
+      host, port        -- address to listen on (port 0 picks a free port)
+      latency           -- seconds to wait before answering each request
+      latency_jitter    -- extra random delay of up to this many seconds
+      unavailable_rate  -- fraction of requests answered with HTTP 503
+                           "Service Unavailable"
+      unavailable_after_processing -- fraction of those 503s sent *after*
+                           the transaction was processed (the ambiguous case
+                           ExportTransaction is used to resolve)
+      decline_rate      -- fraction of sales/authorizations declined
+      partial_auth_rate -- fraction of sales/authorizations partially
+                           approved (unless ENABLEPARTIALAUTH is 'N')
+      export_records    -- number of synthetic records added to every
+                           ExportTranx response, on top of the transactions
+                           the simulator has processed
+      seed              -- seed for the random outcomes
+
+    Transactions the simulator approves are kept in memory, so Void,
+    Capture, Refund and ExportTranx requests can refer to them.
+
+    """
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 latency_jitter=0.0, unavailable_rate=0.0,
+                 unavailable_after_processing=0.5, decline_rate=0.0,
+                 partial_auth_rate=0.0, export_records=0, seed=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.unavailable_rate = unavailable_rate
+        self.unavailable_after_processing = unavailable_after_processing
+        self.decline_rate = decline_rate
+        self.partial_auth_rate = partial_auth_rate
+        self.export_records = export_records
+        self.random = random.Random(seed)
+        self.transactions = {}
+        self.stats = Counter()
+        self._transaction_ids = itertools.count(10000000)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._writers = set()
+
+    @property
+    def post_url(self):
+        """The URL to use in place of paytrace.POST_URL."""
+        return 'http://{0}:{1}/api/default.pay'.format(self.host, self.port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start serving in a background thread."""
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(started,), daemon=True
+        )
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        """Stop serving and wait for the background thread to finish."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def serve_forever(self):
+        """Serve in the current thread until interrupted."""
+        self._run(threading.Event())
+
+    def _run(self, started):
+        loop = self._loop = asyncio.new_event_loop()
+        self._server = loop.run_until_complete(asyncio.start_server(
+            self._handle_connection, self.host, self.port
+        ))
+        self.port = self._server.sockets[0].getsockname()[1]
+        started.set()
+        try:
+            loop.run_forever()
+        finally:
+            # Closing the open connections lets their handlers finish.
+            self._server.close()
+            for writer in list(self._writers):
+                writer.close()
+            handlers = asyncio.all_tasks(loop)
+            if handlers:
+                loop.run_until_complete(
+                    asyncio.gather(*handlers, return_exceptions=True)
+                )
+            loop.close()
+
+    async def _handle_connection(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                headers = {}
+                for line in head.decode('latin-1').split('\r\n')[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length)
+
+                response = await self._respond(body)
+                writer.write(response)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, body):
+        delay = self.latency
+        if self.latency_jitter:
+            delay += self.random.uniform(0, self.latency_jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.random.random() < self.unavailable_rate:
+            self.stats['unavailable'] += 1
+            if self.random.random() < self.unavailable_after_processing:
+                try:
+                    self.process(parse_parmlist(body))
+                except ValueError:
+                    pass
+            return SERVICE_UNAVAILABLE
+
+        try:
+            fields = parse_parmlist(body)
+        except ValueError as exc:
+            content = format_response([('ERROR', 'Invalid request: %s' % exc)])
+        else:
+            content = self.process(fields)
+        return (
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/html; charset=utf-8\r\n'
+            b'Content-Length: %d\r\n'
+            b'\r\n' % len(content)
+        ) + content
+
+    def process(self, fields):
+        """Process one request's fields and return the response body."""
+        method = fields.get('METHOD')
+        if not fields.get('UN') or not fields.get('PSWD'):
+            self.stats['error'] += 1
+            return format_response([
+                ('ERROR', '998. Log in failed for insufficient permissions.')
+            ])
+        handler = getattr(self, '_method_' + str(method).upper(), None)
+        if handler is None:
+            self.stats['error'] += 1
+            return format_response([
+                ('ERROR', '81. Please provide a valid Method.')
+            ])
+        return format_response(handler(fields))
+
+    def _method_PROCESSTRANX(self, fields):
+        tranxtype = fields.get('TRANXTYPE')
+        if tranxtype not in PROCESSED:
+            self.stats['error'] += 1
+            return [('ERROR', '82. Please provide a valid Transaction Type.')]
+        self.stats[tranxtype] += 1
+
+        if tranxtype in ('Void', 'Capture') or (
+                tranxtype == 'Refund' and 'TRANXID' in fields):
+            original = self.transactions.get(fields.get('TRANXID'))
+            if original is None:
+                self.stats['error'] += 1
+                return [
+                    ('ERROR', '58. Please provide a valid Transaction ID.')
+                ]
+            if tranxtype == 'Void':
+                original['STATUS'] = 'Voided'
+                self.stats['Voided'] += 1
+            elif tranxtype == 'Capture':
+                original['STATUS'] = 'Pending Settlement'
+                self.stats['Pending Settlement'] += 1
+            if tranxtype != 'Refund':
+                return [
+                    ('RESPONSE', PROCESSED[tranxtype]),
+                    ('TRANSACTIONID', original['TRANXID']),
+                ]
+            fields = dict(original, TRANXTYPE=tranxtype)
+
+        response = PROCESSED[tranxtype]
+        status = 'Pending Settlement'
+        amount = fields.get('AMOUNT', '')
+        if tranxtype in ('Sale', 'Authorization'):
+            if self.random.random() < self.decline_rate:
+                response, status = DECLINED, 'Declined'
+            elif (self.random.random() < self.partial_auth_rate and
+                    fields.get('ENABLEPARTIALAUTH') != 'N' and amount):
+                response = PARTIALLY_APPROVED
+                amount = '%.2f' % (float(amount) / 2)
+        self.stats[status] += 1
+
+        transaction_id = str(next(self._transaction_ids))
+        self.transactions[transaction_id] = {
+            'TRANXID': transaction_id,
+            'TRANXTYPE': tranxtype,
+            'AMOUNT': amount,
+            'CUSTID': fields.get('CUSTID', ''),
+            'INVOICE': fields.get('INVOICE', ''),
+            'CUSTREF': fields.get('CUSTREF', ''),
+            'DESCRIPTION': fields.get('DESCRIPTION', ''),
+            'WHEN': datetime.now().strftime('%m/%d/%Y %H:%M:%S'),
+            'STATUS': status,
+        }
+        result = [('RESPONSE', response), ('TRANSACTIONID', transaction_id)]
+        if status == 'Declined':
+            return result
+        if response == PARTIALLY_APPROVED:
+            result.append(('APPROVEDAMOUNT', amount))
+        if tranxtype in ('Sale', 'Authorization', 'Force', 'Str/FWD'):
+            result += [
+                ('APPCODE', 'TAS%03d' % (int(transaction_id) % 1000)),
+                ('APPMSG', '  NO  MATCH      - Approved and completed'),
+                ('AVSRESPONSE', 'No Match'),
+                ('CSCRESPONSE', 'Match' if 'CSC' in fields else ''),
+            ]
+        return result
+
+    def _method_CREATECUSTOMER(self, fields):
+        self.stats['CreateCustomer'] += 1
+        return [('RESPONSE', '160. The customer profile for {0}/{1} was '
+                 'successfully created.'.format(fields.get('CUSTID'),
+                                                fields.get('BNAME')))]
+
+    def _method_UPDATECUSTOMER(self, fields):
+        self.stats['UpdateCustomer'] += 1
+        return [('RESPONSE', '161. The customer profile for {0} was '
+                 'successfully updated.'.format(fields.get('CUSTID')))]
+
+    def _method_DELETECUSTOMER(self, fields):
+        self.stats['DeleteCustomer'] += 1
+        return [('RESPONSE', '162. The customer profile for {0} was '
+                 'successfully deleted.'.format(fields.get('CUSTID')))]
+
+    def _method_EMAILRECEIPT(self, fields):
+        self.stats['EmailReceipt'] += 1
+        return [('RESPONSE', '149. Your receipt for transaction ID {0} was '
+                 'successfully emailed to {1}.'.format(
+                     fields.get('TRANXID') or fields.get('CHECKID'),
+                     fields.get('EMAIL')))]
+
+    def _method_EXPORTTRANX(self, fields):
+        self.stats['ExportTranx'] += 1
+        if 'TRANXID' in fields:
+            transaction = self.transactions.get(fields['TRANXID'])
+            records = [transaction] if transaction else []
+        else:
+            searchtext = fields.get('SEARCHTEXT')
+            sdate = _parse_date(fields.get('SDATE', '01/01/0001'))
+            edate = _parse_date(fields.get('EDATE', '12/31/9999'))
+            candidates = itertools.chain(
+                self.transactions.values(),
+                self._synthetic_records(fields.get('SDATE')),
+            )
+            records = [
+                transaction for transaction in candidates
+                if (not searchtext or searchtext in transaction.values()) and
+                sdate <= _parse_date(transaction['WHEN'][:10]) <= edate
+            ]
+        if not records:
+            return [('ERROR', '1. No transactions were found with these '
+                     'criteria.')]
+        return [
+            ('TRANSACTIONRECORD', '+'.join(
+                '{0}={1}'.format(key, value) for key, value in record.items()
+            ))
+            for record in records
+        ]
+
+    def _synthetic_records(self, sdate):
+        when = (sdate or datetime.now().strftime('%m/%d/%Y')) + ' 12:00:00'
+        for i in range(self.export_records):
+            yield {
+                'TRANXID': str(i + 1),
+                'TRANXTYPE': 'Sale',
+                'AMOUNT': '%d.%02d' % divmod(i % 100000 + 100, 100),
+                'CUSTID': 'customer%d' % (i % 1000),
+                'INVOICE': str(i + 1),
+                'CUSTREF': '',
+                'DESCRIPTION': 'Synthetic transaction',
+                'WHEN': when,
+                'STATUS': 'Settled',
+            }
+
+    def _method_EXPORTBATCH(self, fields):
+        self.stats['ExportBatch'] += 1
+        settled = [
+            transaction for transaction in self.transactions.values()
+            if transaction['STATUS'] == 'Pending Settlement'
+        ]
+        amount = sum(float(t['AMOUNT'] or 0) for t in settled)
+        return [
+            ('BATCHNUMBER', fields.get('BATCHNUMBER', '1')),
+            ('TRANSACTIONCOUNT', str(len(settled))),
+            ('NETAMOUNT', '%.2f' % amount),
+        ]
+
+    def _method_SETTLETRANX(self, fields):
+        self.stats['SettleTranx'] += 1
+        count = 0
+        for transaction in self.transactions.values():
+            if transaction['STATUS'] == 'Pending Settlement':
+                transaction['STATUS'] = 'Settled'
+                count += 1
+        return [
+            ('RESPONSE', '200. Your batch was successfully initiated.'),
+            ('SETTLEDCOUNT', str(count)),
+        ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a local PayTrace gateway simulator.'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--latency-jitter', type=float, default=0.0)
+    parser.add_argument('--unavailable-rate', type=float, default=0.0)
+    parser.add_argument('--decline-rate', type=float, default=0.0)
+    parser.add_argument('--partial-auth-rate', type=float, default=0.0)
+    parser.add_argument('--export-records', type=int, default=0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    simulator = GatewaySimulator(
+        host=args.host, port=args.port, latency=args.latency,
+        latency_jitter=args.latency_jitter,
+        unavailable_rate=args.unavailable_rate,
+        decline_rate=args.decline_rate,
+        partial_auth_rate=args.partial_auth_rate,
+        export_records=args.export_records, seed=args.seed,
+    )
+    print('Simulating the PayTrace gateway at %s' % simulator.post_url)
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
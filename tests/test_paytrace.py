@@ -0,0 +1,471 @@
+"""
+Tests for the paytrace module. Nothing is sent to PayTrace; requests are
+answered by a MemoryTransport.
+
+Run from the repository root:
+
+  python3 -m unittest discover tests
+
+"""
+
+import gc
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import weakref
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import paytrace
+
+
+NO_TRANSACTIONS = (
+    'ERROR~1. No transactions were found with these search parameters.|'
+)
+
+
+def make_client(transport, **kwargs):
+    return paytrace.PayTraceClient(
+        transport=transport,
+        credentials=paytrace.Credentials('demo123', 'demo123'),
+        **kwargs
+    )
+
+
+CARD = dict(cc='4012881888818888', expmnth='01', expyr='15')
+
+# Every request class, with representative keyword arguments and its
+# default Scheduler priority.
+REQUESTS = [
+    (paytrace.Sale, dict(amount='1.00', **CARD),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.Authorization, dict(amount='1.00', **CARD),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.Refund, dict(tranxid='1539'), paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.Void, dict(tranxid='1539'), paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.ForcedSale, dict(amount='1.00', approval='TAS113', **CARD),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.Capture, dict(tranxid='1539'), paytrace.PRIORITY_BULK),
+    (paytrace.CashAdvance, dict(
+        amount='100.00', swipe='%B4012881888818888^DOE/JOHN^1501101?',
+        cashadvance='Y', photoid='D123', idexp='12/20', last4='8888',
+        bname='John Doe', baddress='123 Main St.', baddress2='',
+        bcity='Madison',
+        bstate='WI', bzip='53719',
+    ), paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.StoreAndForward, dict(amount='1.00', custid='customer1'),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.CreateCustomer, dict(custid='customer1', bname='John Doe',
+                                   **CARD),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.UpdateCustomer, dict(custid='customer1'),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.DeleteCustomer, dict(custid='customer1'),
+     paytrace.PRIORITY_INTERACTIVE),
+    (paytrace.EmailReceipt, dict(email='j@example.com', tranxid='1539'),
+     paytrace.PRIORITY_BACKGROUND),
+    (paytrace.ExportTransaction, dict(sdate='01/01/2013', edate='01/31/2013'),
+     paytrace.PRIORITY_BACKGROUND),
+    (paytrace.ExportBatch, dict(sdate='01/31/2013'),
+     paytrace.PRIORITY_BACKGROUND),
+    (paytrace.SettleTranxRequest, dict(), paytrace.PRIORITY_BULK),
+]
+
+
+class DefaultPriorityTest(unittest.TestCase):
+
+    def test_every_request_class(self):
+        for cls, kwargs, priority in REQUESTS:
+            self.assertEqual(
+                paytrace.default_priority(cls(**kwargs)), priority,
+                cls.__name__,
+            )
+
+    def test_every_request_class_is_covered(self):
+        classes = set(
+            value for value in vars(paytrace).values()
+            if isinstance(value, type) and
+            issubclass(value, paytrace.PayTraceRequest) and
+            value is not paytrace.PayTraceRequest
+        )
+        self.assertEqual(classes, set(cls for cls, _, _ in REQUESTS))
+
+
+class ReprTest(unittest.TestCase):
+
+    def test_repr_leaves_out_credentials(self):
+        paytrace.set_credentials('default', 'default-secret')
+        self.addCleanup(paytrace.set_credentials, None, None)
+        void = paytrace.Void(tranxid='1539')
+        with paytrace.use_credentials(
+                paytrace.Credentials('merchantA', 'secret')):
+            text = repr(void)
+        self.assertEqual(text, "Void(**{'METHOD': 'ProcessTranx', "
+                               "'TERMS': 'Y', 'TRANXID': '1539', "
+                               "'TRANXTYPE': 'Void'})")
+
+
+class RequestTemplateTest(unittest.TestCase):
+
+    def test_template_classes_are_freed(self):
+        credentials = paytrace.Credentials('demo123', 'demo123')
+        template = paytrace.Sale.template(amount='1.00')
+        template(custid='customer1').to_bytes(credentials)
+        request_class = weakref.ref(template.request_class)
+        del template
+        gc.collect()
+        self.assertIsNone(request_class())
+
+    def test_segments_are_not_keyed_on_the_password(self):
+        credentials = paytrace.Credentials('demo123', 'secret')
+        paytrace.Sale(amount='1.00', custid='c1').to_bytes(credentials)
+        for key in paytrace.Sale._segments:
+            self.assertNotIn('secret', key)
+
+
+class AdaptiveTimeoutsTest(unittest.TestCase):
+
+    def test_streamed_lookups_dont_set_range_export_timeouts(self):
+        transport = paytrace.MemoryTransport(
+            lambda data: 'TRANSACTIONRECORD~TRANXID=1|'
+        )
+        timeouts = paytrace.AdaptiveTimeouts(min_samples=5)
+        lookup = paytrace.ExportTransaction(tranxid='1')
+        export = paytrace.ExportTransaction(
+            sdate='01/01/2013', edate='01/01/2013'
+        )
+        with make_client(transport, timeouts=timeouts) as client:
+            for _ in range(5):
+                list(client.stream(lookup))
+        self.assertIsInstance(timeouts.timeout(lookup, 60), tuple)
+        self.assertEqual(timeouts.timeout(export, 60), 60)
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = paytrace.MemoryTransport()
+        self.client = make_client(self.transport)
+        self.export = paytrace.ExportBatch(sdate='01/31/2013')
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_iter_records_rejects_an_empty_body(self):
+        with self.assertRaises(paytrace.UnexpectedResponseError):
+            list(paytrace.iter_records([b'']))
+
+    def test_empty_body_raises(self):
+        self.transport.queue(b'')
+        with self.assertRaises(Exception) as context:
+            list(self.client.stream(self.export))
+        self.assertIsInstance(context.exception.args[1]['exc_instance'],
+                              paytrace.UnexpectedResponseError)
+
+    def test_http_error_raises(self):
+        self.transport.queue(b'RESPONSE~OK|', status_code=503)
+        with self.assertRaises(Exception) as context:
+            list(self.client.stream(self.export))
+        self.assertTrue(paytrace.is_service_unavailable(context.exception))
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_template_requests_are_cached(self):
+        transport = paytrace.MemoryTransport()
+        transport.queue('TRANSACTIONRECORD~TRANXID=1|')
+        template = paytrace.ExportTransaction.template(sdate='01/01/2013')
+        export = template(edate='01/02/2013')
+        with make_client(transport, cache=paytrace.ResponseCache()) as client:
+            self.assertEqual(client.send(export), client.send(export))
+        self.assertEqual(len(transport.requests), 1)
+
+    def test_cache_hits_bypass_the_scheduler(self):
+        transport = paytrace.MemoryTransport()
+        transport.queue('TRANSACTIONRECORD~TRANXID=1|')
+        # One request now, then one every 1000 seconds.
+        scheduler = paytrace.Scheduler(rate=0.001, burst=1)
+        export = paytrace.ExportBatch(sdate='01/31/2013')
+        with make_client(transport, cache=paytrace.ResponseCache(),
+                         scheduler=scheduler) as client:
+            client.send(export)
+            client.send(export)
+        self.assertEqual(scheduler.stats()['wait'][
+            paytrace.PRIORITY_BACKGROUND]['count'], 1)
+
+
+class TransactionColumnsTest(unittest.TestCase):
+
+    def test_invalid_amount_names_the_row(self):
+        columns = paytrace.TransactionColumns(
+            [{'TRANXID': '1', 'AMOUNT': '1.00'}]
+        )
+        with self.assertRaisesRegex(paytrace.PayTraceError, 'row 1'):
+            columns.extend([{'TRANXID': '2', 'AMOUNT': 'n/a'}])
+        self.assertEqual(len(columns), 1)
+        self.assertEqual(columns.total(), 100)
+
+
+class TransactionStoreTest(unittest.TestCase):
+
+    def make_store(self, batch_response):
+        def handler(data):
+            if b'METHOD~ExportBatch%7C' in data:
+                return batch_response
+            return NO_TRANSACTIONS
+        client = make_client(paytrace.MemoryTransport(handler))
+        self.addCleanup(client.close)
+        store = paytrace.TransactionStore(':memory:', client)
+        self.addCleanup(store.close)
+        return store
+
+    def test_no_batch_moves_the_watermark(self):
+        store = self.make_store('ERROR~1. No batches were found.|')
+        store.sync(start='01/01/2013', until='01/02/2013')
+        self.assertEqual(store.watermark, date(2013, 1, 2))
+
+    def test_batch_export_error_keeps_the_watermark(self):
+        store = self.make_store('ERROR~998. Log in failed.|')
+        with self.assertRaises(paytrace.PayTraceError):
+            store.sync(start='01/01/2013', until='01/02/2013')
+        self.assertIsNone(store.watermark)
+
+
+class ReconcilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = paytrace.MemoryTransport()
+        self.client = make_client(self.transport)
+        self.reconciler = paytrace.Reconciler(self.client)
+        self.sale = paytrace.Sale(amount='1.00', custid='c1', invoice='8888')
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_service_unavailable_is_added(self):
+        self.transport.queue('Service Unavailable', status_code=503)
+        self.assertIsNone(self.reconciler.send(self.sale))
+        self.assertEqual(len(self.reconciler), 1)
+
+    def test_no_transactions_is_safe_to_retry(self):
+        self.reconciler.add(self.sale)
+        self.transport.queue(NO_TRANSACTIONS)
+        result = self.reconciler.reconcile()
+        self.assertEqual(result.safe_to_retry, [self.sale])
+        self.assertEqual(result.errors, [])
+        self.assertEqual(len(self.reconciler), 0)
+
+    def test_matching_record_is_processed(self):
+        self.reconciler.add(self.sale)
+        self.transport.queue(
+            'TRANSACTIONRECORD~TRANXID=1+TRANXTYPE=Sale+INVOICE=8888|'
+        )
+        result = self.reconciler.reconcile()
+        self.assertEqual([r for r, record in result.processed], [self.sale])
+        self.assertEqual(result.safe_to_retry, [])
+
+    def test_query_covers_the_days_around(self):
+        # The gateway's date may differ from ours near midnight.
+        self.reconciler.add(self.sale, date(2013, 1, 15))
+        self.transport.queue(NO_TRANSACTIONS)
+        self.reconciler.reconcile()
+        data = self.transport.requests[-1][1]
+        self.assertIn(b'SDATE~01%2F14%2F2013%7C', data)
+        self.assertIn(b'EDATE~01%2F16%2F2013%7C', data)
+
+    def test_export_error_is_not_safe_to_retry(self):
+        # An export that fails says nothing about the pending requests;
+        # retrying them could charge twice.
+        self.reconciler.add(self.sale)
+        self.transport.queue('ERROR~998. Log in failed for insufficient '
+                             'permissions.|')
+        result = self.reconciler.reconcile()
+        self.assertEqual(result.safe_to_retry, [])
+        self.assertEqual(len(result.errors), 1)
+        self.assertIsInstance(result.errors[0], paytrace.PayTraceError)
+        self.assertEqual(len(self.reconciler), 1)
+
+    def test_export_without_records_is_not_safe_to_retry(self):
+        # A restarting gateway often answers with an empty 502 or 503, and
+        # neither that nor a body without records says the sale wasn't
+        # processed.
+        for body, status_code in ((b'', 503), (b'', 200),
+                                  (b'RESPONSE~OK|', 200)):
+            with self.subTest(body=body, status_code=status_code):
+                reconciler = paytrace.Reconciler(self.client)
+                reconciler.add(self.sale)
+                self.transport.queue(body, status_code=status_code)
+                result = reconciler.reconcile()
+                self.assertEqual(result.safe_to_retry, [])
+                self.assertEqual(len(result.errors), 1)
+                self.assertEqual(len(reconciler), 1)
+
+
+class ExportTransactionsTest(unittest.TestCase):
+
+    def test_invalid_arguments(self):
+        for kwargs in (dict(shard_days=0), dict(max_workers=0)):
+            with self.assertRaises(ValueError):
+                paytrace.export_transactions(
+                    '01/01/2013', '01/31/2013', client=object(), **kwargs
+                )
+
+
+class OutboundJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.transport = paytrace.MemoryTransport()
+        self.client = paytrace.PayTraceClient(transport=self.transport)
+        self.path = os.path.join(directory, 'journal.sqlite')
+        self.journal = paytrace.OutboundJournal(self.path, self.client)
+        self.addCleanup(self.journal.close)
+        self.merchant = paytrace.Credentials('merchantA', 'secret')
+        self.transport.queue(ConnectionError('connection reset'))
+        with paytrace.use_credentials(self.merchant):
+            with self.assertRaises(Exception):
+                self.journal.send(paytrace.Capture(tranxid='42'))
+
+    def test_card_data_is_not_journaled_or_resent(self):
+        sale = paytrace.Sale(amount='1.00', invoice='8888', csc='999',
+                             **CARD)
+        self.transport.queue(ConnectionError('connection reset'))
+        with paytrace.use_credentials(self.merchant):
+            with self.assertRaises(Exception):
+                self.journal.send(sale)
+        db = sqlite3.connect(self.path)
+        self.addCleanup(db.close)
+        rows = db.execute('SELECT fields FROM journal').fetchall()
+        self.assertNotIn('4012881888818888', repr(rows))
+        self.assertNotIn('999', repr(rows))
+        self.assertIn('************8888', repr(rows))
+
+        self.transport.queue(NO_TRANSACTIONS)
+        self.transport.queue('RESPONSE~112. Your transaction was '
+                             'successfully captured.|TRANSACTIONID~42|')
+        result = self.journal.replay(credentials=[self.merchant])
+        self.assertEqual(len(result.safe_to_retry), 2)
+        # Only the Capture was sent again; the Sale stays pending.
+        self.assertIn(b'TRANXTYPE~Capture%7C', self.transport.requests[-1][1])
+        self.assertEqual(
+            [request.TRANXTYPE for request in self.journal.pending()],
+            ['Sale'],
+        )
+
+    def test_replay_refuses_unknown_accounts(self):
+        other = paytrace.Credentials('merchantB', 'secret')
+        with paytrace.use_credentials(other):
+            result = self.journal.replay()
+        self.assertEqual(len(result.unmatchable), 1)
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(len(self.transport.requests), 1)
+        self.assertEqual(len(self.journal.pending()), 1)
+
+    def test_replay_refuses_another_test_mode(self):
+        test_merchant = self.merchant._replace(test_mode=True)
+        result = self.journal.replay(credentials=[test_merchant])
+        self.assertEqual(len(result.errors), 1)
+        self.assertEqual(len(self.journal.pending()), 1)
+
+    def test_replay_as_the_journaled_account(self):
+        self.transport.queue('RESPONSE~112. Your transaction was '
+                             'successfully captured.|TRANSACTIONID~42|')
+        result = self.journal.replay(
+            credentials={'merchantA': self.merchant}
+        )
+        self.assertEqual(result.errors, [])
+        self.assertIn(b'UN~merchantA%7C', self.transport.requests[-1][1])
+        self.assertEqual(self.journal.pending(), [])
+
+
+class RunPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.input_path = os.path.join(directory, 'input.csv')
+        self.output_path = os.path.join(directory, 'output.jsonl')
+        self.exports = []  # responses to ExportTranx, in order
+        self.sales = 0
+        self.transport = paytrace.MemoryTransport(self.answer)
+        self.client = make_client(self.transport)
+        self.addCleanup(self.client.close)
+
+    def answer(self, data):
+        if b'METHOD~ExportTranx%7C' in data:
+            return self.exports.pop(0)
+        self.sales += 1
+        return 'RESPONSE~101. Your transaction was successfully approved.|'
+
+    def run_pipeline(self, rows):
+        with open(self.input_path, 'w') as f:
+            f.write('custid,amount,invoice\n')
+            f.writelines(','.join(row) + '\n' for row in rows)
+        return paytrace.run_pipeline(
+            self.input_path, self.output_path, client=self.client
+        )
+
+    def output(self):
+        with open(self.output_path) as f:
+            return [json.loads(line) for line in f]
+
+    def crash_before_output(self, rows):
+        """Send rows, then lose their output, as if the run had crashed."""
+        self.run_pipeline(rows)
+        self.assertEqual(self.sales, len(rows))
+        open(self.output_path, 'w').close()
+        self.sales = 0
+
+    def test_sent(self):
+        counts = self.run_pipeline([('c1', '1.00', 'inv1')])
+        self.assertEqual(counts, {'sent': 1})
+        self.assertEqual(self.output()[0]['status'], 'sent')
+
+    def test_resume_reconciles_instead_of_sending_again(self):
+        self.crash_before_output([('c1', '1.00', 'inv1')])
+        self.exports.append(
+            'TRANSACTIONRECORD~TRANXID=7+TRANXTYPE=Sale+INVOICE=inv1|'
+        )
+        counts = self.run_pipeline([('c1', '1.00', 'inv1')])
+        self.assertEqual(counts, {'processed': 1})
+        self.assertEqual(self.sales, 0)
+        self.assertEqual(self.output()[0]['record']['TRANXID'], '7')
+
+    def test_resume_sends_rows_the_gateway_has_no_record_of(self):
+        self.crash_before_output([('c1', '1.00', 'inv1')])
+        self.exports.append(NO_TRANSACTIONS)
+        counts = self.run_pipeline([('c1', '1.00', 'inv1')])
+        self.assertEqual(counts, {'sent': 1})
+        self.assertEqual(self.sales, 1)
+
+    def test_resume_without_invoice_is_unknown(self):
+        self.crash_before_output([('c1', '1.00', '')])
+        counts = self.run_pipeline([('c1', '1.00', '')])
+        self.assertEqual(counts, {'unknown': 1})
+        self.assertEqual(self.sales, 0)
+        self.assertEqual(self.output()[0]['status'], 'unknown')
+
+    def test_resume_with_failed_export_is_unresolved(self):
+        self.crash_before_output([('c1', '1.00', 'inv1')])
+        self.exports.append('ERROR~998. Log in failed.|')
+        counts = self.run_pipeline([('c1', '1.00', 'inv1')])
+        self.assertEqual(counts, {'unresolved': 1})
+        self.assertEqual(self.sales, 0)
+        self.assertEqual(self.output(), [])
+
+        # The next run resolves it.
+        self.exports.append(
+            'TRANSACTIONRECORD~TRANXID=7+TRANXTYPE=Sale+INVOICE=inv1|'
+        )
+        counts = self.run_pipeline([('c1', '1.00', 'inv1')])
+        self.assertEqual(counts, {'processed': 1})
+        self.assertEqual(self.sales, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()